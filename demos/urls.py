@@ -34,6 +34,7 @@ urlpatterns = [
     path('buffer-invias/', views.generar_buffer_invias, name='buffer_invias'),
     path('pipeline/run', views.run_pipeline, name="run_pipeline"),
     path('kripley/run', views.runHotRipley, name="run_kripley"),
+    path('kripley/status/<str:run_id>', views.statusHotRipley, name="status_kripley"),
     # path('makemosaic/run', views.run_mosaic_nacional_view, name="run_mosaic"),
     ################################################################ 
     # path("run/", views.run_mosaics_page, name="run_mosaics_page"),
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import numpy as np
+
+
+class EnvolventeCuantiles:
+
+    # Acumulador de envolventes de simulación por columna. Guarda la suma
+    # (para la media) y solo las colas necesarias para reproducir exactamente
+    # np.quantile (método lineal) en los niveles pedidos: para n simulaciones
+    # y nivel q bastan los floor((n-1)q)+2 menores o los n-floor((n-1)q)
+    # mayores. La memoria depende de las colas, no de n_sim.
+
+    def __init__(self, n_total, n_col, q_lo=0.025, q_hi=0.975):
+
+        self.n_total = int(n_total)
+        self.n_col = int(n_col)
+        self.q_lo = float(q_lo)
+        self.q_hi = float(q_hi)
+
+        self.k_lo = min(self.n_total, int(math.floor((self.n_total - 1) * self.q_lo)) + 2)
+        self.k_hi = min(self.n_total, self.n_total - int(math.floor((self.n_total - 1) * self.q_hi)))
+
+        self.n = 0
+        self.suma = np.zeros(self.n_col)
+        self.menores = np.empty((0, self.n_col))
+        self.mayores = np.empty((0, self.n_col))
+
+    def agregar(self, bloque):
+
+        # Incorpora un bloque (n_block, n_col) de simulaciones
+        bloque = np.asarray(bloque, dtype=float)
+        if not len(bloque):
+            return self
+        self.n += len(bloque)
+        self.suma += bloque.sum(axis=0)
+        self.menores = self._recortar(np.vstack([self.menores, bloque]), self.k_lo, False)
+        self.mayores = self._recortar(np.vstack([self.mayores, bloque]), self.k_hi, True)
+        return self
+
+    def combinar(self, otro):
+
+        # Une un acumulador parcial (p. ej. devuelto por un worker)
+        self.n += otro.n
+        self.suma += otro.suma
+        self.menores = self._recortar(np.vstack([self.menores, otro.menores]), self.k_lo, False)
+        self.mayores = self._recortar(np.vstack([self.mayores, otro.mayores]), self.k_hi, True)
+        return self
+
+    def parcial(self):
+
+        # Acumulador vacío con las mismas colas, para llenar por bloques
+        return EnvolventeCuantiles(self.n_total, self.n_col, self.q_lo, self.q_hi)
+
+    def _recortar(self, filas, k, mayores):
+        if len(filas) <= k:
+            return filas
+        if mayores:
+            return np.partition(filas, len(filas) - k, axis=0)[len(filas) - k:]
+        return np.partition(filas, k - 1, axis=0)[:k]
+
+    # ==================================================
+    # RESULTADOS
+    # ==================================================
+
+    def media(self):
+        return self.suma / max(1, self.n)
+
+    def cuantiles(self, desplazamiento=None):
+
+        # (lo, hi) idénticos a np.quantile(sims - desplazamiento, q, axis=0)
+        if self.n != self.n_total:
+            raise ValueError(f"Se esperaban {self.n_total} simulaciones y se acumularon {self.n}")
+
+        lo = self._cuantil_lineal(np.sort(self.menores, axis=0), self.q_lo, 0, desplazamiento)
+        hi = self._cuantil_lineal(np.sort(self.mayores, axis=0), self.q_hi, self.n - len(self.mayores), desplazamiento)
+        return lo, hi
+
+    def _cuantil_lineal(self, ordenadas, q, base, desplazamiento):
+        h = (self.n - 1) * q
+        i = int(math.floor(h)) - base
+        j = min(i + 1, len(ordenadas) - 1)
+        a = ordenadas[i]
+        b = ordenadas[j]
+        if desplazamiento is not None:
+            a = a - desplazamiento
+            b = b - desplazamiento
+        return a + (h - math.floor(h)) * (b - a)
@@ -1,20 +1,71 @@
 # -*- coding: utf-8 -*-
 
-import os, json, math, warnings
+import os, json, math, time, warnings, hashlib, shutil, uuid
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 from tqdm import tqdm
-from shapely.geometry import Point, LineString, MultiLineString, MultiPoint
-from shapely.ops import unary_union, linemerge, nearest_points, split
-from shapely import set_precision
+import shapely
+import pyogrio
+from pyproj import CRS, Transformer
+from pyproj.exceptions import CRSError
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 import matplotlib.pyplot as plt
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from .redDistancias import RedCSR
+from .envolventeCuantiles import EnvolventeCuantiles
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# Radio máximo por defecto en distance_mode="red": el corte de Dijkstra es
+# lo que mantiene acotado el cálculo en redes grandes
+R_MAX_RED_DEFAULT_M = 10000.0
+
+# Redes preparadas en este proceso, por clave de contenido y parámetros
+_CACHE_RED = {}
+_CACHE_RED_MAX = 2
+_HASH_ARCHIVOS = {}
+
+# Eventos ya leídos en este proceso, por hash del Excel, hoja y campos
+_CACHE_EVENTOS = {}
+_CACHE_EVENTOS_MAX = 4
+
+# CRS métrico por defecto (MAGNA-SIRGAS / Origen-Nacional)
+CRS_METRICO_DEFAULT = "EPSG:9377"
+
+
+def crs_metrico(metric_crs):
+
+    # metric_crs=True -> CRS_METRICO_DEFAULT; cualquier otro valor debe ser un
+    # CRS proyectado en metros, porque tolerancias y radios se usan tal cual
+    crs = CRS_METRICO_DEFAULT if metric_crs is True else str(metric_crs)
+    try:
+        ejes = CRS(crs).axis_info
+    except CRSError as e:
+        raise ValueError(f"metric_crs inválido: {crs} ({e})")
+    if not ejes or ejes[0].unit_name != "metre":
+        raise ValueError(f"metric_crs debe estar en metros: {crs}")
+    return crs
+
+
 class KRipley_HS:
 
+    # Progreso en output_folder/status.json; None en instancias sin reporte
+    # (workers, uso directo de los métodos)
+    _estado_folder = None
+    _etapa = None
+    _sim_total = 0
+    _sim_hechas = 0
+
+    # CRS de cálculo: EPSG:4326 con factores metros/grado por lat0, o un CRS
+    # métrico donde todas las distancias y longitudes ya están en metros
+    crs = "EPSG:4326"
+    metrico = False
+
     def __init__(self,
                  excel_path,
                  excel_sheet,
@@ -37,31 +88,50 @@ class KRipley_HS:
                  export_shp_vias_colapsadas_name,
                  plot_png,
                  n_workers,
-                 max_hs_sample_points):
+                 max_hs_sample_points,
+                 cache_folder=None,
+                 distance_mode="2d",
+                 r_max_m=None,
+                 metric_crs=None):
+
+        # "2d": distancia euclidiana entre puntos pegados a la red
+        # "red": distancia de camino mínimo sobre el grafo de la red
+        if distance_mode not in ("2d", "red"):
+            raise ValueError(f"distance_mode no soportado: {distance_mode}")
+        if distance_mode == "red" and r_max_m is None:
+            r_max_m = R_MAX_RED_DEFAULT_M
+        if r_max_m is not None and float(r_max_m) < float(r_start_m):
+            raise ValueError(f"r_max_m ({r_max_m}) debe ser mayor o igual que r_start_m ({r_start_m})")
 
         os.makedirs(output_folder, exist_ok=True)
 
+        self._estado_folder = output_folder
+        self._sim_total = int(n_sim_ripley) + int(n_sim_hotspot)
+
         # --------------------------------------------------
         # EVENTOS
         # --------------------------------------------------
 
-        ev = self.cargar_eventos_excel(excel_path, excel_sheet, lat_field, lon_field)
+        self._reportar("eventos")
+
+        ev = self.cargar_eventos_excel(excel_path, excel_sheet, lat_field, lon_field, cache_folder)
         ev = ev[ev.is_valid & ~ev.is_empty & ~ev.geometry.isna()].copy()
         ev = self.asegurar_crs_4326(ev)
 
         if len(ev) < 2:
             raise ValueError("Se requieren al menos dos eventos")
 
-        lat0 = float(ev.geometry.y.mean())
-        m_lat, m_lon = self.metros_por_grado(lat0)
-
-        # --------------------------------------------------
-        # VIAS
-        # --------------------------------------------------
+        # Latitud de referencia de la red (centro de su extensión), no de los
+        # eventos: así la red preparada y su cache no dependen del Excel
+        lat0 = self.latitud_centro_vias(roads_path)
 
-        vi = gpd.read_file(roads_path)
-        vi = vi[vi.is_valid & ~vi.geometry.isna()].explode(index_parts=False).reset_index(drop=True)
-        vi = self.asegurar_crs_4326(vi)
+        if metric_crs:
+            self.crs = crs_metrico(metric_crs)
+            self.metrico = True
+            ev = ev.to_crs(self.crs)
+            m_lat, m_lon = 1.0, 1.0
+        else:
+            m_lat, m_lon = self.metros_por_grado(lat0)
 
         # --------------------------------------------------
         # CONVERSION METROS A GRADOS
@@ -73,27 +143,21 @@ class KRipley_HS:
         hs_step_deg  = self.m_a_deg_conservador(hs_point_spacing_m,   m_lat, m_lon, "min")
 
         # --------------------------------------------------
-        # COLAPSAR RED
+        # VIAS: COLAPSAR Y SEGMENTAR (CON CACHE)
         # --------------------------------------------------
 
-        cl = self.colapsar_y_simplificar_red_4326(
-            vi=vi,
-            simplify_deg=float(simplify_deg),
-            precision_scale=float(precision_scale)
-        )
-
+        self._reportar("red")
         shp_out = os.path.join(output_folder, export_shp_vias_colapsadas_name)
-        self.exportar_shp_4326(cl, shp_out)
-
-        # --------------------------------------------------
-        # SEGMENTAR RED
-        # --------------------------------------------------
 
-        cl_seg = self.segmentar_lineas_4326(
-            gdf=cl,
-            spacing_deg=float(segment_deg),
-            meters_per_deg_lat=m_lat,
-            meters_per_deg_lon=m_lon
+        cl, cl_seg, tree_seg = self.preparar_red_4326(
+            roads_path=roads_path,
+            simplify_deg=float(simplify_deg),
+            segment_deg=float(segment_deg),
+            precision_scale=float(precision_scale),
+            m_lat=m_lat,
+            m_lon=m_lon,
+            shp_out=shp_out,
+            cache_folder=cache_folder
         )
 
         D_m = float(cl_seg["length_m"].sum())
@@ -104,7 +168,8 @@ class KRipley_HS:
         # SNAP EVENTOS
         # --------------------------------------------------
 
-        snapped = self.snap_eventos_a_red_4326(ev, cl_seg, snap_deg)
+        self._reportar("snap")
+        snapped = self.snap_eventos_a_red_4326(ev, cl_seg, snap_deg, tree_seg)
         snapped = snapped[snapped.is_valid & ~snapped.is_empty & ~snapped.geometry.isna()].copy()
 
         if len(snapped) < 2:
@@ -118,28 +183,46 @@ class KRipley_HS:
             r_step_m = segment_spacing_m
 
         r_vals_m = np.arange(r_start_m, D_m + r_step_m, r_step_m)
+        if r_max_m is not None:
+            r_vals_m = r_vals_m[r_vals_m <= float(r_max_m)]
+        if not len(r_vals_m):
+            raise ValueError(f"No hay radios entre r_start_m ({r_start_m}) y la longitud de la red ({D_m:.0f} m)")
 
         # --------------------------------------------------
         # RIPLEY K
         # --------------------------------------------------
 
-        K_obs, sims = self.ripley_k_red_2d_fast_4326(
+        self._reportar("ripley")
+        K_obs, env = self.ripley_k_red_2d_fast_4326(
             cl_seg,
             snapped,
             r_vals_m,
             m_lat,
             m_lon,
             n_sim_ripley,
-            random_seed
+            random_seed,
+            n_workers,
+            distance_mode=distance_mode
         )
 
-        K_env_lo = np.quantile(sims, 0.025, axis=0)
-        K_env_hi = np.quantile(sims, 0.975, axis=0)
+        K_env_lo, K_env_hi = env.cuantiles()
 
-        L_obs, L_lo, L_hi = self.calcular_L(K_obs, sims)
+        L_obs, L_lo, L_hi = self.calcular_L(K_obs, env)
 
         if plot_png:
-            self.graficar_L(r_vals_m, L_obs, L_lo, L_hi, r_step_m, output_folder)
+            self.graficar_L(r_vals_m, L_obs, L_lo, L_hi, r_step_m, output_folder,
+                            "L_en_red_2D_pegada.png" if distance_mode == "2d" else "L_en_red_camino_minimo.png")
+
+        # La curva L queda disponible mientras se calculan los hotspots
+        pd.DataFrame({
+            "r_m": r_vals_m,
+            "K_obs": K_obs,
+            "K_env_lo": K_env_lo,
+            "K_env_hi": K_env_hi,
+            "L_obs": L_obs,
+            "L_env_lo": L_lo,
+            "L_env_hi": L_hi
+        }).to_csv(os.path.join(output_folder, export_csv_ripley_name), index=False)
 
         signif = r_vals_m[L_obs > L_hi]
         r_star = float(signif.min()) if len(signif) else None
@@ -149,8 +232,10 @@ class KRipley_HS:
         # --------------------------------------------------
 
         if r_star is None:
+            self._sim_total = int(n_sim_ripley)
             hs_csv = pd.DataFrame(columns=["Latitude", "Longitude", "HS", "HS_Intense", "UCL", "LCL"])
         else:
+            self._reportar("hotspots")
             hs_csv = self.hotspots_siriema_real_ci_4326(
                 cl_seg,
                 snapped,
@@ -169,16 +254,7 @@ class KRipley_HS:
         # EXPORTS
         # --------------------------------------------------
 
-        pd.DataFrame({
-            "r_m": r_vals_m,
-            "K_obs": K_obs,
-            "K_env_lo": K_env_lo,
-            "K_env_hi": K_env_hi,
-            "L_obs": L_obs,
-            "L_env_lo": L_lo,
-            "L_env_hi": L_hi
-        }).to_csv(os.path.join(output_folder, export_csv_ripley_name), index=False)
-
+        self._reportar("exportando")
         hs_csv.to_csv(os.path.join(output_folder, export_csv_hotspots_name), index=False)
 
         # --------------------------------------------------
@@ -188,11 +264,35 @@ class KRipley_HS:
         with open(os.path.join(output_folder, "metadata.json"), "w", encoding="utf-8") as f:
             json.dump({
                 "crs": "EPSG:4326",
+                "crs_calculo": self.crs,
                 "lat0": lat0,
+                "distance_mode": distance_mode,
                 "longitud_red_m": D_m,
                 "r_star_m": r_star
             }, f, indent=2)
 
+        self._reportar("terminado", estado="terminado")
+
+    # ==================================================
+    # PROGRESO
+    # ==================================================
+
+    def _reportar(self, etapa=None, simulaciones=0, estado="en_curso"):
+        if self._estado_folder is None:
+            return
+        if etapa is not None:
+            self._etapa = etapa
+        self._sim_hechas += int(simulaciones)
+
+        total = max(1, self._sim_total)
+        guardar_estado(self._estado_folder, {
+            "estado": estado,
+            "etapa": self._etapa,
+            "simulaciones_hechas": self._sim_hechas,
+            "simulaciones_total": self._sim_total,
+            "porcentaje": round(100.0 * min(self._sim_hechas, total) / total, 1)
+        })
+
     # ==================================================
     # UTILIDADES
     # ==================================================
@@ -200,6 +300,19 @@ class KRipley_HS:
     def asegurar_crs_4326(self, gdf):
         return gdf.set_crs("EPSG:4326") if gdf.crs is None else gdf.to_crs("EPSG:4326")
 
+    def asegurar_crs(self, gdf):
+        return self.asegurar_crs_4326(gdf).to_crs(self.crs)
+
+    def latitud_centro_vias(self, roads_path):
+
+        # Solo lee el encabezado de la capa (extensión y CRS)
+        info = pyogrio.read_info(roads_path, force_total_bounds=True)
+        xmin, ymin, xmax, ymax = info["total_bounds"]
+        if info["crs"] and info["crs"] != "EPSG:4326":
+            t = Transformer.from_crs(info["crs"], "EPSG:4326", always_xy=True)
+            xmin, ymin, xmax, ymax = t.transform_bounds(xmin, ymin, xmax, ymax)
+        return float((ymin + ymax) / 2.0)
+
     def metros_por_grado(self, lat):
         return 111111.0, 111111.0 * max(1e-8, math.cos(math.radians(lat)))
 
@@ -208,10 +321,197 @@ class KRipley_HS:
         dlon = m / m_lon
         return max(dlat, dlon) if modo == "max" else min(dlat, dlon)
 
-    def cargar_eventos_excel(self, path, sheet, lat, lon):
+    def cargar_eventos_excel(self, path, sheet, lat, lon, cache_folder=None):
+
+        if not cache_folder:
+            return self._leer_eventos_excel(path, sheet, lat, lon)
+
+        # El Excel se convierte una vez a GeoParquet (geometría ya construida);
+        # mientras no cambie se sirve desde memoria o desde ese archivo
+        h = hashlib.sha256(self._hash_archivo(str(path)).encode())
+        h.update(json.dumps([sheet, lat, lon]).encode())
+        clave = h.hexdigest()
+
+        if clave not in _CACHE_EVENTOS:
+            parquet = os.path.join(cache_folder, f"eventos_{clave[:24]}.parquet")
+
+            if os.path.exists(parquet):
+                ev = gpd.read_parquet(parquet)
+            else:
+                ev = self._leer_eventos_excel(path, sheet, lat, lon)
+                self._guardar_eventos_parquet(ev, parquet)
+
+            while len(_CACHE_EVENTOS) >= _CACHE_EVENTOS_MAX:
+                _CACHE_EVENTOS.pop(next(iter(_CACHE_EVENTOS)))
+            _CACHE_EVENTOS[clave] = ev
+
+        return _CACHE_EVENTOS[clave].copy()
+
+    def _leer_eventos_excel(self, path, sheet, lat, lon):
         df = pd.read_excel(path, sheet_name=sheet).dropna(subset=[lat, lon])
         return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[lon], df[lat]), crs="EPSG:4326")
 
+    def _guardar_eventos_parquet(self, ev, parquet):
+
+        # Columnas object con tipos mezclados (celdas de texto y número) no
+        # tienen tipo Arrow: se guardan como texto
+        ev = ev.copy()
+        for c in ev.columns:
+            if c != ev.geometry.name and ev[c].dtype == object:
+                if pd.api.types.infer_dtype(ev[c], skipna=True) not in ("string", "empty"):
+                    ev[c] = ev[c].map(lambda v: v if pd.isna(v) else str(v))
+                ev[c] = ev[c].astype("string")
+
+        os.makedirs(os.path.dirname(parquet), exist_ok=True)
+        tmp = f"{parquet}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            ev.to_parquet(tmp, index=False)
+            os.replace(tmp, parquet)
+        except ImportError:
+            # Sin pyarrow queda solo la cache en memoria
+            pass
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # ==================================================
+    # CACHE DE RED PREPARADA
+    # ==================================================
+
+    def preparar_red_4326(self, roads_path, simplify_deg, segment_deg, precision_scale,
+                          m_lat, m_lon, shp_out, cache_folder=None):
+
+        if not cache_folder:
+            cl, cl_seg = self._construir_red_4326(roads_path, simplify_deg, segment_deg, precision_scale, m_lat, m_lon)
+            self.exportar_shp_4326(cl, shp_out)
+            return cl, cl_seg, shapely.STRtree(np.asarray(cl_seg.geometry.values))
+
+        # La clave combina el contenido del SHP de vías con los parámetros que
+        # definen la red; en EPSG:4326 los factores metros/grado salen de la
+        # propia capa de vías, así que no cambian con los eventos
+        clave = self._clave_cache_red(roads_path, {
+            "simplify_deg": simplify_deg,
+            "segment_deg": segment_deg,
+            "precision_scale": precision_scale,
+            "crs": self.crs,
+            "m_lat": m_lat,
+            "m_lon": m_lon
+        })
+        carpeta = os.path.join(cache_folder, f"red_{clave[:24]}")
+        shp_cache = os.path.join(carpeta, "vias_simplificadas.shp")
+
+        if clave in _CACHE_RED:
+            cl, cl_seg, tree = _CACHE_RED[clave]
+            # La carpeta en disco pudo borrarse después de cargarla: se publica de nuevo
+            if not os.path.exists(os.path.join(carpeta, "red.npz")):
+                self._guardar_red_cache(carpeta, cl, cl_seg)
+        else:
+            if os.path.exists(os.path.join(carpeta, "red.npz")):
+                cl, cl_seg = self._cargar_red_cache(carpeta)
+            else:
+                cl, cl_seg = self._construir_red_4326(roads_path, simplify_deg, segment_deg, precision_scale, m_lat, m_lon)
+                self._guardar_red_cache(carpeta, cl, cl_seg)
+
+            tree = shapely.STRtree(np.asarray(cl_seg.geometry.values))
+            while len(_CACHE_RED) >= _CACHE_RED_MAX:
+                _CACHE_RED.pop(next(iter(_CACHE_RED)))
+            _CACHE_RED[clave] = (cl, cl_seg, tree)
+
+        if os.path.exists(shp_cache):
+            self._copiar_shp(shp_cache, shp_out)
+        else:
+            self.exportar_shp_4326(cl, shp_out)
+        return cl, cl_seg, tree
+
+    def _construir_red_4326(self, roads_path, simplify_deg, segment_deg, precision_scale, m_lat, m_lon):
+
+        vi = gpd.read_file(roads_path)
+        vi = vi[vi.is_valid & ~vi.geometry.isna()].explode(index_parts=False).reset_index(drop=True)
+        vi = self.asegurar_crs(vi)
+
+        cl = self.colapsar_y_simplificar_red_4326(
+            vi=vi,
+            simplify_deg=simplify_deg,
+            precision_scale=precision_scale
+        )
+
+        cl_seg = self.segmentar_lineas_4326(
+            gdf=cl,
+            spacing_deg=segment_deg,
+            meters_per_deg_lat=m_lat,
+            meters_per_deg_lon=m_lon
+        )
+
+        return cl, cl_seg
+
+    def _clave_cache_red(self, roads_path, params):
+        h = hashlib.sha256()
+        base = os.path.splitext(str(roads_path))[0]
+        for ext in (".shp", ".shx", ".dbf", ".prj", ".cpg"):
+            if os.path.exists(base + ext):
+                h.update(ext.encode())
+                h.update(self._hash_archivo(base + ext).encode())
+        h.update(json.dumps({k: repr(v) for k, v in params.items()}, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _hash_archivo(self, path):
+        st = os.stat(path)
+        firma = (path, st.st_size, st.st_mtime_ns)
+        if firma not in _HASH_ARCHIVOS:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for bloque in iter(lambda: f.read(1 << 20), b""):
+                    h.update(bloque)
+            _HASH_ARCHIVOS[firma] = h.hexdigest()
+        return _HASH_ARCHIVOS[firma]
+
+    def _guardar_red_cache(self, carpeta, cl, cl_seg):
+
+        # Se escribe en una carpeta temporal y se publica con un rename
+        tmp = f"{carpeta}.tmp-{uuid.uuid4().hex[:8]}"
+        os.makedirs(tmp, exist_ok=True)
+
+        cl_xy, cl_idx = shapely.get_coordinates(np.asarray(cl.geometry.values), return_index=True)
+        seg_xy, seg_idx = shapely.get_coordinates(np.asarray(cl_seg.geometry.values), return_index=True)
+
+        np.savez(
+            os.path.join(tmp, "red.npz"),
+            cl_xy=cl_xy,
+            cl_idx=cl_idx,
+            seg_xy=seg_xy,
+            seg_idx=seg_idx,
+            id_src=cl_seg["id_src"].values,
+            length_m=cl_seg["length_m"].values,
+            offset_global_m=cl_seg["offset_global_m"].values
+        )
+        self.exportar_shp_4326(cl, os.path.join(tmp, "vias_simplificadas.shp"))
+
+        try:
+            os.replace(tmp, carpeta)
+        except OSError:
+            # Otra corrida publicó la misma red primero
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _cargar_red_cache(self, carpeta):
+
+        with np.load(os.path.join(carpeta, "red.npz")) as z:
+            cl_geoms = shapely.linestrings(z["cl_xy"], indices=z["cl_idx"])
+            seg_geoms = shapely.linestrings(z["seg_xy"], indices=z["seg_idx"])
+
+            cl = gpd.GeoDataFrame({"id": range(len(cl_geoms))}, geometry=cl_geoms, crs=self.crs)
+            cl_seg = gpd.GeoDataFrame({"id_src": z["id_src"]}, geometry=seg_geoms, crs=self.crs)
+            cl_seg["length_m"] = z["length_m"]
+            cl_seg["offset_global_m"] = z["offset_global_m"]
+
+        return cl, cl_seg
+
+    def _copiar_shp(self, origen, destino):
+        base_o = os.path.splitext(origen)[0]
+        base_d = os.path.splitext(destino)[0]
+        for ext in (".shp", ".shx", ".dbf", ".prj", ".cpg"):
+            if os.path.exists(base_o + ext):
+                shutil.copyfile(base_o + ext, base_d + ext)
+
     # ==================================================
     # COLAPSAR DOBLE CALZADA (REEMPLAZO REFINADO)
     # ==================================================
@@ -225,109 +525,66 @@ class KRipley_HS:
         gdf = gdf.explode(index_parts=False).reset_index(drop=True)
 
         # Aplanar a LineString sin modificar nada
-        geoms = []
-        for g in gdf.geometry.values:
-            if g is None or g.is_empty:
-                continue
-            if isinstance(g, LineString):
-                geoms.append(g)
-            elif isinstance(g, MultiLineString):
-                for p in g.geoms:
-                    if p is not None and not p.is_empty and p.length > 0:
-                        geoms.append(p)
-
-        if not geoms:
-            return gpd.GeoDataFrame({"id": []}, geometry=[], crs="EPSG:4326")
-
-        gs = gpd.GeoSeries(geoms, crs="EPSG:4326")
-        sindex = gs.sindex
-
-        usados = np.zeros(len(gs), dtype=bool)
-        resultado = []
+        geoms = shapely.get_parts(np.asarray(gdf.geometry.values))
+        geoms = geoms[
+            (shapely.get_type_id(geoms) == shapely.GeometryType.LINESTRING)
+            & ~shapely.is_empty(geoms)
+        ]
+
+        if not len(geoms):
+            return gpd.GeoDataFrame({"id": []}, geometry=[], crs=self.crs)
 
         # Tolerancia SOLO para detectar paralelismo (NO modifica geometría)
         tol = float(simplify_deg) * 20.0
 
         # --------------------------------------------------
-        # Eliminación CONSERVADORA de dobles calzadas
+        # Pares candidatos en bloque y criterios vectorizados
         # --------------------------------------------------
-        for i in tqdm(range(len(gs)), total=len(gs), desc="Detectando dobles calzadas"):
-            if usados[i]:
-                continue
-
-            g = gs.iloc[i]
-            if g is None or g.is_empty:
-                usados[i] = True
-                continue
-
-            ang_i = self._angulo_linea(g)
-            len_i = float(g.length)
-
-            minx, miny, maxx, maxy = g.bounds
-            bbox = (minx - tol, miny - tol, maxx + tol, maxy + tol)
-            candidatos = list(sindex.intersection(bbox))
-
-            grupo = [i]
+        tree = shapely.STRtree(geoms)
+        i, j = tree.query(geoms, predicate="dwithin", distance=tol)
+        sel = i < j
+        i, j = i[sel], j[sel]
 
-            for j in candidatos:
-                if j == i or usados[j]:
-                    continue
+        ang = self._angulos_lineas(geoms)
+        lon = shapely.length(geoms)
 
-                gj = gs.iloc[j]
-                if gj is None or gj.is_empty:
-                    continue
+        lon_min = np.minimum(lon[i], lon[j])
+        lon_max = np.maximum(lon[i], lon[j])
+        ratio = np.divide(lon_min, lon_max, out=np.zeros_like(lon_min), where=lon_max > 0)
 
-                # Criterios estrictos
-                if g.distance(gj) > tol:
-                    continue
+        ok = (np.abs(ang[i] - ang[j]) <= 8.0) & (ratio >= 0.97)
+        i, j = i[ok], j[ok]
 
-                ang_j = self._angulo_linea(gj)
-                if abs(ang_i - ang_j) > 8.0:
-                    continue
-
-                len_j = float(gj.length)
-                if min(len_i, len_j) / max(len_i, len_j) < 0.97:
-                    continue
-
-                grupo.append(j)
-
-            # --------------------------------------------------
-            # Decisión SIN RIESGO
-            # --------------------------------------------------
-            if len(grupo) == 1:
-                resultado.append(g)
-                usados[i] = True
-                continue
-
-            # Doble calzada clara → conservar UNA EXACTA
-            idx_keep = max(grupo, key=lambda k: float(gs.iloc[k].length))
-            resultado.append(gs.iloc[idx_keep])
+        # --------------------------------------------------
+        # Agrupar pares aceptados (union-find) y conservar UNA EXACTA:
+        # la más larga de cada grupo
+        # --------------------------------------------------
+        n = len(geoms)
+        grafo = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+        _, grupo = connected_components(grafo, directed=False)
 
-            for k in grupo:
-                usados[k] = True
+        orden = np.lexsort((np.arange(n), -lon, grupo))
+        primero = np.r_[True, grupo[orden][1:] != grupo[orden][:-1]]
+        idx_keep = np.sort(orden[primero])
 
         # --------------------------------------------------
         # Salida SIN ALTERAR TRAZADO
         # --------------------------------------------------
         out = gpd.GeoDataFrame(
-            {"id": range(len(resultado))},
-            geometry=resultado,
-            crs="EPSG:4326"
+            {"id": range(len(idx_keep))},
+            geometry=geoms[idx_keep],
+            crs=self.crs
         )
 
         return out
 
-
-
-
-    def _angulo_linea(self, line):
-        c = np.asarray(line.coords)
-        if c.shape[0] < 2:
-            return 0.0
-        return abs(math.degrees(math.atan2(c[-1, 1] - c[0, 1], c[-1, 0] - c[0, 0]))) % 180.0
+    def _angulos_lineas(self, geoms):
+        ini = shapely.get_coordinates(shapely.get_point(geoms, 0))
+        fin = shapely.get_coordinates(shapely.get_point(geoms, -1))
+        return np.abs(np.degrees(np.arctan2(fin[:, 1] - ini[:, 1], fin[:, 0] - ini[:, 0]))) % 180.0
 
     def exportar_shp_4326(self, gdf, path):
-        gdf[["id", "geometry"]].to_file(path, driver="ESRI Shapefile")
+        gdf[["id", "geometry"]].to_crs("EPSG:4326").to_file(path, driver="ESRI Shapefile")
 
     # ==================================================
     # SEGMENTAR RED (AJUSTE EXCEPT split -> [p])
@@ -335,83 +592,105 @@ class KRipley_HS:
 
     def segmentar_lineas_4326(self, gdf, spacing_deg, meters_per_deg_lat, meters_per_deg_lon):
 
-        segs = []
-        ids = []
-
-        for idx, row in tqdm(gdf.iterrows(), total=len(gdf), desc="Segmentando"):
-            line = row.geometry
-            if line is None or line.is_empty:
-                continue
+        spacing = float(spacing_deg)
 
-            parts = list(line.geoms) if isinstance(line, MultiLineString) else [line]
+        parts, pos_src = shapely.get_parts(np.asarray(gdf.geometry.values), return_index=True)
+        id_src = gdf.index.values[pos_src]
 
-            for p in parts:
-                if p.length <= spacing_deg:
-                    segs.append(p)
-                    ids.append(idx)
-                    continue
+        # Número de piezas por línea: cortes en i * spacing, i = 1 .. n - 1
+        L = shapely.length(parts)
+        n_pz = np.where(L <= spacing, 1, np.maximum(1, np.floor_divide(L, spacing))).astype(np.int64)
+        base = np.cumsum(n_pz) - n_pz
 
-                n = int(p.length // spacing_deg)
-                pts = [Point(p.interpolate(i * spacing_deg)) for i in range(1, n)]
+        segs = np.empty(int(n_pz.sum()), dtype=object)
+        corto = n_pz == 1
+        segs[base[corto]] = parts[corto]
 
-                try:
-                    pieces = split(p, MultiPoint(pts))
-                except Exception:
-                    pieces = p  # fallback
+        largo = np.flatnonzero(~corto)
+        if len(largo):
+            idx, piezas = self._cortar_lineas(parts[largo], L[largo], n_pz[largo], base[largo], spacing)
+            segs[idx] = piezas
 
-                # Normalizar salida de split para que SIEMPRE sea lista iterable
-                if isinstance(pieces, LineString):
-                    parts_out = [pieces]
-                elif hasattr(pieces, "geoms"):  # GeometryCollection / MultiLineString
-                    parts_out = list(pieces.geoms)
-                else:
-                    parts_out = [p]
+        valido = np.repeat(corto, n_pz) | (~shapely.is_empty(segs) & (shapely.length(segs) > 0))
 
-                for s in parts_out:
-                    if s is not None and (not s.is_empty) and s.length > 0:
-                        segs.append(s)
-                        ids.append(idx)
-
-
-        out = gpd.GeoDataFrame({"id_src": ids}, geometry=segs, crs="EPSG:4326")
-        out["length_m"] = out.geometry.apply(lambda g: self.longitud_m_equivalente(g, meters_per_deg_lat, meters_per_deg_lon))
+        out = gpd.GeoDataFrame({"id_src": np.repeat(id_src, n_pz)[valido]}, geometry=segs[valido], crs=self.crs)
+        out["length_m"] = self._longitudes_m_equivalentes(out.geometry.values, meters_per_deg_lat, meters_per_deg_lon)
         out["offset_global_m"] = out["length_m"].cumsum() - out["length_m"]
 
         return out.reset_index(drop=True)
 
-    def longitud_m_equivalente(self, line, m_lat, m_lon):
-        c = np.asarray(line.coords)
-        if c.shape[0] < 2:
-            return 0.0
-        dx = np.diff(c[:, 0]) * m_lon
-        dy = np.diff(c[:, 1]) * m_lat
-        return float(np.sqrt(dx * dx + dy * dy).sum())
+    def _cortar_lineas(self, lines, L, n_pz, base, spacing):
+
+        # Distancia acumulada de cada vértice dentro de su línea
+        xy, v_lin = shapely.get_coordinates(lines, return_index=True)
+        d = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1]))
+        paso = np.r_[0.0, np.where(v_lin[1:] == v_lin[:-1], d, 0.0)]
+        acum = np.cumsum(paso)
+        primero = np.searchsorted(v_lin, np.arange(len(lines)))
+        ultimo = np.r_[primero[1:], len(xy)] - 1
+        d_v = acum - acum[primero][v_lin]
+
+        # Puntos de corte b_0 = 0, b_k = k * spacing, b_n = L (extremos exactos)
+        n_b = n_pz + 1
+        b_lin = np.repeat(np.arange(len(lines)), n_b)
+        b_k = np.arange(n_b.sum()) - np.repeat(np.cumsum(n_b) - n_b, n_b)
+        b_pos = np.where(b_k == n_pz[b_lin], L[b_lin], b_k * spacing)
+        b_xy = shapely.get_coordinates(shapely.line_interpolate_point(lines[b_lin], b_pos))
+        ini = b_k == 0
+        fin = b_k == n_pz[b_lin]
+        b_xy[ini] = xy[primero]
+        b_xy[fin] = xy[ultimo]
+
+        # Cada pieza k: punto inicial, vértices interiores, punto final
+        es_ini = ~fin
+        es_fin = ~ini
+        seg_ini = base[b_lin[es_ini]] + b_k[es_ini]
+        seg_fin = base[b_lin[es_fin]] + b_k[es_fin] - 1
+
+        k_v = np.minimum(np.floor_divide(d_v, spacing).astype(np.int64), n_pz[v_lin] - 1)
+        b0 = k_v * spacing
+        b1 = np.where(k_v + 1 == n_pz[v_lin], L[v_lin], (k_v + 1) * spacing)
+        interior = (d_v > b0) & (d_v < b1)
+        seg_v = base[v_lin[interior]] + k_v[interior]
+
+        seg = np.r_[seg_ini, seg_v, seg_fin]
+        cls = np.r_[np.zeros(len(seg_ini)), np.ones(len(seg_v)), np.full(len(seg_fin), 2.0)]
+        pos = np.r_[b_pos[es_ini], d_v[interior], b_pos[es_fin]]
+        pts = np.vstack([b_xy[es_ini], xy[interior], b_xy[es_fin]])
+
+        orden = np.lexsort((pos, cls, seg))
+        ids, compacto = np.unique(seg[orden], return_inverse=True)
+        return ids, shapely.linestrings(pts[orden], indices=compacto)
 
     # ==================================================
     # SNAP
     # ==================================================
 
-    def snap_eventos_a_red_4326(self, ev, cl_seg, snap_tol_deg):
+    def snap_eventos_a_red_4326(self, ev, cl_seg, snap_tol_deg, tree=None):
+
+        segs = np.asarray(cl_seg.geometry.values)
+        pts = np.asarray(ev.geometry.values)
 
-        sindex = cl_seg.sindex
-        out = []
+        # Segmento más cercano de todos los eventos en una sola consulta
+        if tree is None:
+            tree = shapely.STRtree(segs)
+        i_ev, i_seg = tree.query_nearest(pts, max_distance=snap_tol_deg, all_matches=False)
+        orden = np.argsort(i_ev, kind="stable")
+        i_ev, i_seg = i_ev[orden], i_seg[orden]
 
-        for _, r in tqdm(ev.iterrows(), total=len(ev), desc="Snap eventos"):
-            p = r.geometry
-            cand = list(sindex.query(p.buffer(snap_tol_deg)))
-            if not cand:
-                continue
+        lineas = segs[i_seg]
+        pos = shapely.line_locate_point(lineas, pts[i_ev])
+        snapped = shapely.line_interpolate_point(lineas, pos)
 
-            sub = cl_seg.iloc[cand]
-            nearest = min(sub.itertuples(), key=lambda x: p.distance(x.geometry))
-            _, np2 = nearest_points(p, nearest.geometry)
+        # Posición sobre el segmento en metros, reutilizable por etapas posteriores
+        lon = shapely.length(lineas)
+        frac = np.divide(pos, lon, out=np.zeros(len(pos)), where=lon > 0)
 
-            if p.distance(np2) <= snap_tol_deg:
-                d = r.to_dict()
-                d["geometry"] = np2
-                out.append(d)
+        out = pd.DataFrame(ev.iloc[i_ev].drop(columns=ev.geometry.name)).reset_index(drop=True)
+        out["seg_id"] = i_seg
+        out["offset_seg_m"] = frac * cl_seg["length_m"].values[i_seg]
 
-        return gpd.GeoDataFrame(out, geometry="geometry", crs="EPSG:4326")
+        return gpd.GeoDataFrame(out, geometry=snapped, crs=self.crs)
 
     # ==================================================
     # RIPLEY K
@@ -431,64 +710,135 @@ class KRipley_HS:
     def _contar_pares_por_r(self, dist, r_vals):
         return np.searchsorted(dist, r_vals, side="right")
 
-    def _generar_puntos_sobre_red_4326(self, n, cl_seg, rng):
+    def _ubicar_en_red_4326(self, s, offs, lens, breaks):
 
-        offs = cl_seg["offset_global_m"].values
-        lens = cl_seg["length_m"].values
-        geoms = cl_seg.geometry.values
+        # Segmento y offset (m) dentro del segmento para cada posición s
+        idx = np.searchsorted(breaks, s, side="right")
+        idx = np.minimum(idx, len(breaks) - 1)
+        off = np.clip(s - offs[idx], 0.0, lens[idx])
+        return idx, off
 
-        breaks = offs + lens
-        D = breaks[-1]
+    def _interpolar_en_red_4326(self, s, offs, lens, breaks, geoms):
 
-        s = rng.uniform(0, D, n)
-        idx = np.searchsorted(breaks, s, side="right")
+        # s: posiciones en metros sobre la red concatenada, de cualquier forma.
+        # Devuelve coordenadas (..., 2) con una sola llamada vectorizada.
+        s = np.asarray(s, dtype=float)
+        idx, off = self._ubicar_en_red_4326(s.ravel(), offs, lens, breaks)
+
+        seg_len = lens[idx]
+        frac = np.divide(off, seg_len, out=np.zeros_like(off), where=seg_len > 0)
 
-        pts = np.zeros((n, 2))
-        for i in range(n):
-            seg = idx[i]
-            frac = (s[i] - offs[seg]) / lens[seg] if lens[seg] > 0 else 0.0
-            p = geoms[seg].interpolate(frac, normalized=True)
-            pts[i] = [p.x, p.y]
+        pts = shapely.line_interpolate_point(geoms[idx], frac, normalized=True)
+        return shapely.get_coordinates(pts).reshape(s.shape + (2,))
 
-        return pts
+    def _ripley_bloque(self, n_block, n, seed_seq, offs, lens, breaks, geoms, r_vals, m_lat, m_lon, D, red=None):
 
-    def ripley_k_red_2d_fast_4326(self, cl_seg, snapped, r_vals, m_lat, m_lon, n_sim, seed):
+        # Un bloque de simulaciones de envolvente con su propio generador;
+        # el resultado depende solo de la semilla del bloque
+        rng = np.random.default_rng(seed_seq)
+        s_rand = rng.uniform(0, breaks[-1], (n_block, n))
+        pts_sim = self._interpolar_en_red_4326(s_rand, offs, lens, breaks, geoms)
+        if red is not None:
+            seg_sim, off_sim = self._ubicar_en_red_4326(s_rand, offs, lens, breaks)
+
+        out = np.zeros((n_block, len(r_vals)))
+        for i in range(n_block):
+            if red is None:
+                dv = self._distancias_2d_pares_m(pts_sim[i], m_lat, m_lon)
+            else:
+                dv = red.distancias_pares(seg_sim[i], off_sim[i], pts_sim[i] * [m_lon, m_lat], r_vals[-1])
+            cnt = self._contar_pares_por_r(dv, r_vals)
+            out[i] = (D / (n * (n - 1))) * (2.0 * cnt)
+
+        return out
+
+    def ripley_k_red_2d_fast_4326(self, cl_seg, snapped, r_vals, m_lat, m_lon, n_sim, seed, n_workers=1, bloque=25,
+                                  distance_mode="2d"):
 
-        rng = np.random.default_rng(seed)
         n = len(snapped)
         D = cl_seg["length_m"].sum()
+        r_vals = np.asarray(r_vals, dtype=float)
+
+        red = None
+        if distance_mode == "red":
+            seg_xy, seg_idx = shapely.get_coordinates(np.asarray(cl_seg.geometry.values), return_index=True)
+            red = RedCSR(seg_xy, seg_idx, cl_seg["length_m"].values, m_lat, m_lon)
 
         obs = np.vstack([snapped.geometry.x, snapped.geometry.y]).T
-        dv = self._distancias_2d_pares_m(obs, m_lat, m_lon)
+        if red is None:
+            dv = self._distancias_2d_pares_m(obs, m_lat, m_lon)
+        else:
+            dv = red.distancias_pares(
+                snapped["seg_id"].values, snapped["offset_seg_m"].values, obs * [m_lon, m_lat], r_vals[-1]
+            )
         cnt = self._contar_pares_por_r(dv, r_vals)
         K_obs = (D / (n * (n - 1))) * (2.0 * cnt)
 
-        sims = np.zeros((n_sim, len(r_vals)))
-        for i in tqdm(range(n_sim), desc="Ripley"):
-            pts = self._generar_puntos_sobre_red_4326(n, cl_seg, rng)
-            dv = self._distancias_2d_pares_m(pts, m_lat, m_lon)
-            cnt = self._contar_pares_por_r(dv, r_vals)
-            sims[i] = (D / (n * (n - 1))) * (2.0 * cnt)
+        # Bloques de tamaño fijo con semillas derivadas de random_seed: el
+        # resultado es idéntico en serie y con cualquier número de workers
+        n_sim = int(n_sim)
+        starts = list(range(0, n_sim, bloque))
+        seeds = np.random.SeedSequence(int(seed)).spawn(len(starts))
+        tasks = [(st, min(bloque, n_sim - st), ss) for st, ss in zip(starts, seeds)]
 
-        return K_obs, sims
+        offs = cl_seg["offset_global_m"].values.astype(float)
+        lens = cl_seg["length_m"].values.astype(float)
+        breaks = offs + lens
+        geoms = np.asarray(cl_seg.geometry.values)
+
+        # Solo se conservan media y colas de la envolvente, no todas las simulaciones
+        env = EnvolventeCuantiles(n_sim, len(r_vals))
+
+        if n_workers is None or int(n_workers) <= 1 or len(tasks) <= 1:
+            for st, n_block, ss in tqdm(tasks, desc="Ripley"):
+                env.agregar(self._ripley_bloque(
+                    n_block, n, ss, offs, lens, breaks, geoms, r_vals, m_lat, m_lon, D, red
+                ))
+                self._reportar(simulaciones=n_block)
+            return K_obs, env
+
+        seg_xy, seg_idx = shapely.get_coordinates(geoms, return_index=True)
+        bloques_shm, specs = _publicar_arreglos({
+            "seg_xy": seg_xy,
+            "seg_idx": seg_idx,
+            "seg_offsets": offs,
+            "seg_lengths": lens,
+            "breaks": breaks,
+            "r_vals": r_vals
+        })
+        escalares = {"D": float(D), "n_events": int(n), "m_lat": float(m_lat), "m_lon": float(m_lon),
+                     "distance_mode": distance_mode}
+
+        try:
+            with ProcessPoolExecutor(max_workers=int(n_workers),
+                                     initializer=_inicializar_worker_red,
+                                     initargs=(specs, escalares)) as ex:
+                res = _resultados_en_orden(ex, _worker_ripley_bloque, tasks, 2 * int(n_workers))
+                for st, block in tqdm(res, total=len(tasks), desc="Ripley (paralelo)"):
+                    env.agregar(block)
+                    self._reportar(simulaciones=len(block))
+        finally:
+            _liberar_arreglos(bloques_shm)
+
+        return K_obs, env
 
     # ==================================================
     # L FUNCTION
     # ==================================================
 
-    def calcular_L(self, K_obs, sims):
-        mean = sims.mean(axis=0)
+    def calcular_L(self, K_obs, env):
+        mean = env.media()
         L_obs = K_obs - mean
-        L_sims = sims - mean
-        return L_obs, np.quantile(L_sims, 0.025, axis=0), np.quantile(L_sims, 0.975, axis=0)
+        L_lo, L_hi = env.cuantiles(mean)
+        return L_obs, L_lo, L_hi
 
-    def graficar_L(self, r, L, L_lo, L_hi, step, folder):
+    def graficar_L(self, r, L, L_lo, L_hi, step, folder, nombre="L_en_red_2D_pegada.png"):
         fig, ax = plt.subplots()
         ax.plot(r, L_hi)
         ax.plot(r, L_lo)
         ax.plot(r, L)
         ax.axhline(0)
-        fig.savefig(os.path.join(folder, "L_en_red_2D_pegada.png"), dpi=150)
+        fig.savefig(os.path.join(folder, nombre), dpi=150)
         plt.close(fig)
 
     # ==================================================
@@ -514,255 +864,395 @@ class KRipley_HS:
         if max_hs_sample_points and len(sample_pts) > max_hs_sample_points:
             sample_pts = sample_pts.sample(max_hs_sample_points, random_state=seed)
 
-        union_red = unary_union(cl_seg.geometry)
+        # Ci depende solo del punto de muestreo y del radio: se calcula una vez
+        Ci = self.calcular_Ci_4326(
+            sample_pts,
+            cl_seg,
+            r_deg,
+            m_lat,
+            m_lon,
+            n_workers
+        )
 
         H_obs = self.calcular_H_con_Ci_4326(
             sample_pts,
             snapped.geometry,
-            union_red,
+            Ci,
             r_deg,
-            m_lat,
-            m_lon,
             r_opt_m
         )
 
-        H_sim = self.simular_H_con_Ci_4326(
+        env = self.simular_H_con_Ci_4326(
             sample_pts,
             cl_seg,
-            union_red,
+            Ci,
             r_deg,
             r_opt_m,
-            m_lat,
-            m_lon,
             len(snapped),
             n_sim,
             seed,
             n_workers
         )
 
-        HS, UCL, LCL = self.calcular_HS_UCL_LCL(H_obs, H_sim)
+        HS, UCL, LCL = self.calcular_HS_UCL_LCL(H_obs, env)
         mask = HS > UCL
 
         gdf = sample_pts.loc[mask].copy()
         gdf["HS"] = HS[mask]
         gdf["UCL"] = UCL[mask]
         gdf["LCL"] = LCL[mask]
-        gdf["Longitude"] = gdf.geometry.x
-        gdf["Latitude"] = gdf.geometry.y
+        geo = gdf.geometry.to_crs("EPSG:4326")
+        gdf["Longitude"] = geo.x
+        gdf["Latitude"] = geo.y
 
         return pd.DataFrame(gdf[["Latitude", "Longitude", "HS", "UCL", "LCL"]])
 
     def generar_puntos_muestreo_en_red_4326(self, cl_seg, spacing_deg):
 
-        pts = []
-        for _, r in tqdm(cl_seg.iterrows(), total=len(cl_seg), desc="Puntos HS"):
-            line = r.geometry
-            L = line.length
-            if L <= spacing_deg:
-                pts.append(line.interpolate(0))
-            else:
-                n = int(L // spacing_deg)
-                for i in range(n + 1):
-                    pts.append(line.interpolate(min(i * spacing_deg, L)))
+        # Puntos cada spacing_deg desde el inicio de cada segmento (incluido el
+        # extremo final cuando cae justo en un múltiplo), en una sola pasada
+        segs = np.asarray(cl_seg.geometry.values)
+        L = shapely.length(segs)
+        n_pts = np.where(L <= spacing_deg, 0, np.floor_divide(L, spacing_deg)).astype(np.int64) + 1
+
+        seg_id = np.repeat(np.arange(len(segs)), n_pts)
+        k = np.arange(len(seg_id)) - np.repeat(np.cumsum(n_pts) - n_pts, n_pts)
+        pos = np.minimum(k * spacing_deg, L[seg_id])
+
+        pts = shapely.line_interpolate_point(segs[seg_id], pos)
+
+        # Misma convención que el snap de eventos: offset en metros sobre el segmento
+        frac = np.divide(pos, L[seg_id], out=np.zeros(len(pos)), where=L[seg_id] > 0)
+
+        return gpd.GeoDataFrame({
+            "seg_id": seg_id,
+            "offset_seg_m": frac * cl_seg["length_m"].values[seg_id]
+        }, geometry=pts, crs=self.crs)
+
+    def calcular_Ci_4326(self, sample_pts, cl_seg, r_deg, m_lat, m_lon, n_workers, bloque=5000):
+
+        # Longitud de red (m) dentro de cada círculo de muestreo, igual a la de
+        # union_red ∩ círculo. Se intersecta cada círculo solo con los
+        # segmentos candidatos del STRtree y las piezas de cada círculo se
+        # disuelven antes de medir: vías superpuestas que la colapsación no
+        # eliminó no se cuentan dos veces.
+        circles = shapely.buffer(np.asarray(sample_pts.geometry.values), r_deg, quad_segs=16)
+        segs = np.asarray(cl_seg.geometry.values)
+        tree = shapely.STRtree(segs)
+
+        def _ci_bloque(ix):
+            i_c, i_s = tree.query(circles[ix], predicate="intersects")
+            orden = np.argsort(i_c, kind="stable")
+            i_c, i_s = i_c[orden], i_s[orden]
+            piezas = shapely.intersection(segs[i_s], circles[ix][i_c])
+
+            grupos, inicio = np.unique(i_c, return_index=True)
+            unidas = np.empty(len(grupos), dtype=object)
+            for k, g in enumerate(np.split(piezas, inicio[1:])):
+                unidas[k] = g[0] if len(g) == 1 else shapely.union_all(g)
+
+            ci = np.zeros(len(ix))
+            ci[grupos] = self._longitudes_m_equivalentes(unidas, m_lat, m_lon)
+            return ix, ci
+
+        Ci = np.zeros(len(circles))
+        bloques = [np.arange(i, min(i + bloque, len(circles))) for i in range(0, len(circles), bloque)]
+
+        # shapely libera el GIL en las operaciones vectorizadas: basta con hilos
+        with ThreadPoolExecutor(max_workers=max(1, int(n_workers))) as ex:
+            for ix, ci in tqdm(ex.map(_ci_bloque, bloques), total=len(bloques), desc="Ci"):
+                Ci[ix] = ci
 
-        return gpd.GeoDataFrame(geometry=pts, crs="EPSG:4326")
+        return Ci
 
-    def calcular_H_con_Ci_4326(self, sample_pts, events_geom, union_red, r_deg, m_lat, m_lon, r_opt_m):
+    def _factor_H(self, Ci, r_opt_m):
+        return np.divide(2.0 * r_opt_m, Ci, out=np.zeros(len(Ci)), where=Ci > 0)
 
-        ev = gpd.GeoDataFrame(geometry=events_geom, crs="EPSG:4326")
-        sidx = ev.sindex
-        H = np.zeros(len(sample_pts))
+    def _contar_eventos_en_radio(self, tree_muestras, eventos_xy, r, bloque=50):
 
-        for i, r in tqdm(sample_pts.iterrows(), total=len(sample_pts), desc="H obs"):
-            p = r.geometry
-            circle = p.buffer(r_deg)
-            cand = list(sidx.query(circle))
-            n = ev.iloc[cand].geometry.within(circle).sum() if cand else 0
-            Ci = self.longitud_geom_m_equivalente(union_red.intersection(circle), m_lat, m_lon)
-            H[i] = n * (2.0 * r_opt_m / Ci) if Ci > 0 else 0.0
+        # Cuenta, para cada punto de muestreo, los eventos a distancia <= r.
+        # eventos_xy puede ser (n_ev, 2) o (n_sim, n_ev, 2); devuelve siempre
+        # una matriz densa (n_sim, n_muestras). Las simulaciones se agrupan en
+        # un solo KD-tree por bloque y se cruzan con el árbol de muestras.
+        eventos_xy = np.asarray(eventos_xy, dtype=float)
+        if eventos_xy.ndim == 2:
+            eventos_xy = eventos_xy[None, :, :]
 
-        return H
+        n_sim, n_ev = eventos_xy.shape[:2]
+        n_m = tree_muestras.n
+        cnt = np.zeros((n_sim, n_m), dtype=np.int32)
+
+        for s0 in range(0, n_sim, bloque):
+            xy = eventos_xy[s0:s0 + bloque]
+            tree_ev = cKDTree(xy.reshape(-1, 2))
+            pares = tree_muestras.sparse_distance_matrix(tree_ev, r, output_type="ndarray")
+            sim = pares["j"] // n_ev
+            cnt[s0:s0 + len(xy)] = np.bincount(
+                sim * n_m + pares["i"], minlength=len(xy) * n_m
+            ).reshape(len(xy), n_m)
+
+        return cnt
+
+    def calcular_H_con_Ci_4326(self, sample_pts, events_geom, Ci, r_deg, r_opt_m):
+
+        tree = cKDTree(shapely.get_coordinates(sample_pts.geometry.values))
+        ev_xy = shapely.get_coordinates(events_geom.values)
+
+        cnt = self._contar_eventos_en_radio(tree, ev_xy, r_deg)[0]
+        return cnt * self._factor_H(Ci, r_opt_m)
 
     def simular_H_con_Ci_4326(self,
                               sample_pts,
                               cl_seg,
-                              union_red,
+                              Ci,
                               r_deg,
                               r_opt_m,
-                              m_lat,
-                              m_lon,
                               n_events,
                               n_sim,
                               seed,
-                              n_workers):
+                              n_workers,
+                              bloque=50):
+
+        # Bloques de tamaño fijo con semillas derivadas de seed, como en
+        # Ripley: serie y paralelo dan la misma envolvente
+        n_sim = int(n_sim)
+        starts = list(range(0, n_sim, bloque))
+        seeds = np.random.SeedSequence(int(seed)).spawn(len(starts))
+        tasks = [(st, min(bloque, n_sim - st), ss) for st, ss in zip(starts, seeds)]
 
-        if n_workers <= 1:
+        if n_workers is None or int(n_workers) <= 1 or len(tasks) <= 1:
             return self.simular_H_con_Ci_4326_serial(
-                sample_pts, cl_seg, union_red, r_deg, r_opt_m, m_lat, m_lon, n_events, n_sim, seed
+                sample_pts, cl_seg, Ci, r_deg, r_opt_m, n_events, n_sim, tasks
             )
 
         return self.simular_H_con_Ci_4326_parallel(
-            sample_pts, cl_seg, union_red, r_deg, r_opt_m, m_lat, m_lon, n_events, n_sim, seed, n_workers
+            sample_pts, cl_seg, Ci, r_deg, r_opt_m, n_events, n_sim, tasks, n_workers
         )
 
+    def _hs_bloque(self, env, n_block, seed_seq, offs, lens, breaks, geoms, tree, r_deg, fac, n_events):
+
+        # Un bloque de simulaciones de H reducido a su acumulador parcial
+        rng = np.random.default_rng(seed_seq)
+        s_rand = rng.uniform(0, breaks[-1], (n_block, n_events))
+        sim_xy = self._interpolar_en_red_4326(s_rand, offs, lens, breaks, geoms)
+
+        parcial = env.parcial()
+        parcial.agregar(self._contar_eventos_en_radio(tree, sim_xy, r_deg) * fac)
+        return parcial
+
     def simular_H_con_Ci_4326_serial(self,
                                      sample_pts,
                                      cl_seg,
-                                     union_red,
+                                     Ci,
                                      r_deg,
                                      r_opt_m,
-                                     m_lat,
-                                     m_lon,
                                      n_events,
                                      n_sim,
-                                     seed):
-
-        rng = np.random.default_rng(seed)
+                                     tasks):
 
-        offs = cl_seg["offset_global_m"].values
-        lens = cl_seg["length_m"].values
-        geoms = cl_seg.geometry.values
+        offs = cl_seg["offset_global_m"].values.astype(float)
+        lens = cl_seg["length_m"].values.astype(float)
         breaks = offs + lens
-        D = breaks[-1]
-
-        circles = [g.buffer(r_deg) for g in sample_pts.geometry]
-        H_sim = np.zeros((n_sim, len(sample_pts)))
-
-        for s in tqdm(range(n_sim), desc="HS sim"):
-            s_rand = rng.uniform(0, D, n_events)
-            idx = np.searchsorted(breaks, s_rand, side="right")
-
-            sim_pts = []
-            for i in range(n_events):
-                frac = (s_rand[i] - offs[idx[i]]) / lens[idx[i]]
-                p = geoms[idx[i]].interpolate(frac, normalized=True)
-                sim_pts.append(p)
-
-            sim = gpd.GeoDataFrame(geometry=sim_pts, crs="EPSG:4326")
-            sidx = sim.sindex
-
-            for i, c in enumerate(circles):
-                cand = list(sidx.query(c))
-                n = sim.iloc[cand].geometry.within(c).sum() if cand else 0
-                Ci = self.longitud_geom_m_equivalente(union_red.intersection(c), m_lat, m_lon)
-                H_sim[s, i] = n * (2.0 * r_opt_m / Ci) if Ci > 0 else 0.0
-
-        return H_sim
-
-    def _worker_sim_block(self, args):
-
-        (start_idx,
-         n_block,
-         seed,
-         seg_offsets,
-         seg_lengths,
-         breaks,
-         geoms,
-         D,
-         circles_wkb,
-         r_opt_m,
-         m_lat,
-         m_lon,
-         n_events,
-         union_red_wkb) = args
-
-        from shapely import wkb
-
-        union_red = wkb.loads(union_red_wkb)
-        circles = [wkb.loads(b) for b in circles_wkb]
-        rng = np.random.default_rng(seed)
-
-        block = np.zeros((n_block, len(circles)))
-
-        for s in range(n_block):
-            s_rand = rng.uniform(0, D, n_events)
-            idx = np.searchsorted(breaks, s_rand, side="right")
-
-            sim_pts = []
-            for i in range(n_events):
-                frac = (s_rand[i] - seg_offsets[idx[i]]) / seg_lengths[idx[i]]
-                p = geoms[idx[i]].interpolate(frac, normalized=True)
-                sim_pts.append(p)
-
-            sim = gpd.GeoDataFrame(geometry=sim_pts, crs="EPSG:4326")
-            sidx = sim.sindex
-
-            for i, c in enumerate(circles):
-                cand = list(sidx.query(c))
-                n = sim.iloc[cand].geometry.within(c).sum() if cand else 0
-                Ci = self.longitud_geom_m_equivalente(union_red.intersection(c), m_lat, m_lon)
-                block[s, i] = n * (2.0 * r_opt_m / Ci) if Ci > 0 else 0.0
-
-        return start_idx, block
+        geoms = np.asarray(cl_seg.geometry.values)
+
+        fac = self._factor_H(Ci, r_opt_m)
+        tree = cKDTree(shapely.get_coordinates(sample_pts.geometry.values))
+        env = EnvolventeCuantiles(n_sim, len(sample_pts))
+
+        for st, n_block, ss in tqdm(tasks, desc="HS sim"):
+            env.combinar(self._hs_bloque(
+                env, n_block, ss, offs, lens, breaks, geoms, tree, r_deg, fac, int(n_events)
+            ))
+            self._reportar(simulaciones=n_block)
+
+        return env
 
     def simular_H_con_Ci_4326_parallel(self,
                                        sample_pts,
                                        cl_seg,
-                                       union_red,
+                                       Ci,
                                        r_deg,
                                        r_opt_m,
-                                       meters_per_deg_lat,
-                                       meters_per_deg_lon,
                                        n_events,
                                        n_sim,
-                                       seed,
+                                       tasks,
                                        n_workers):
 
         seg_offsets = cl_seg["offset_global_m"].values.astype(float)
         seg_lengths = cl_seg["length_m"].values.astype(float)
-        geoms = cl_seg.geometry.values
+        seg_xy, seg_idx = shapely.get_coordinates(np.asarray(cl_seg.geometry.values), return_index=True)
         breaks = seg_offsets + seg_lengths
-        D = float(breaks[-1])
 
-        circles = [g.buffer(float(r_deg)) for g in sample_pts.geometry]
-
-        from shapely import wkb
-        circles_wkb = [wkb.dumps(c) for c in circles]
-        union_red_wkb = wkb.dumps(union_red)
+        sample_xy = shapely.get_coordinates(sample_pts.geometry.values)
+        fac = self._factor_H(Ci, r_opt_m)
+
+        # Las tareas solo llevan (inicio, tamaño, semilla); los datos de solo
+        # lectura se publican una vez en memoria compartida y cada worker
+        # devuelve el acumulador parcial de su bloque, no las simulaciones
+        bloques_shm, specs = _publicar_arreglos({
+            "seg_xy": seg_xy,
+            "seg_idx": seg_idx,
+            "seg_offsets": seg_offsets,
+            "seg_lengths": seg_lengths,
+            "breaks": breaks,
+            "sample_xy": sample_xy,
+            "fac": fac
+        })
+        escalares = {"r_deg": float(r_deg), "n_events": int(n_events), "n_sim": int(n_sim)}
+
+        env = EnvolventeCuantiles(n_sim, len(sample_pts))
+
+        try:
+            with ProcessPoolExecutor(max_workers=int(n_workers),
+                                     initializer=_inicializar_worker_red,
+                                     initargs=(specs, escalares)) as ex:
+                res = _resultados_en_orden(ex, _worker_hs_bloque, tasks, 2 * int(n_workers))
+                for st, parcial in tqdm(res, total=len(tasks), desc="Simulaciones HS (paralelo)"):
+                    env.combinar(parcial)
+                    self._reportar(simulaciones=parcial.n)
+        finally:
+            _liberar_arreglos(bloques_shm)
+
+        return env
+
+    def _longitudes_m_equivalentes(self, geoms, m_lat, m_lon):
+
+        # Longitud en metros equivalentes (factores metros/grado) de un arreglo
+        # de geometrías: se separan las partes para no unir tramos disjuntos.
+        # En CRS métrico la longitud ya está en metros.
+        geoms = np.asarray(geoms)
+        if self.metrico:
+            return shapely.length(geoms)
+        partes, idx_geom = shapely.get_parts(geoms, return_index=True)
+        xy, idx_parte = shapely.get_coordinates(partes, return_index=True)
+
+        dx = np.diff(xy[:, 0]) * m_lon
+        dy = np.diff(xy[:, 1]) * m_lat
+        misma = idx_parte[1:] == idx_parte[:-1]
+
+        lon_parte = np.bincount(
+            idx_parte[1:][misma],
+            weights=np.sqrt(dx * dx + dy * dy)[misma],
+            minlength=len(partes)
+        )
+        return np.bincount(idx_geom, weights=lon_parte, minlength=len(geoms))
 
-        n_sim = int(n_sim)
-        n_workers = max(2, int(n_workers))
-        chunk = max(1, int(math.ceil(n_sim / n_workers)))
-
-        tasks = []
-        start = 0
-        while start < n_sim:
-            n_block = min(chunk, n_sim - start)
-            block_seed = int(seed) + int(start) * 97 + 13
-
-            tasks.append((
-                start, n_block, block_seed,
-                seg_offsets, seg_lengths, breaks, geoms, D,
-                circles_wkb, r_opt_m,
-                meters_per_deg_lat, meters_per_deg_lon,
-                n_events, union_red_wkb
-            ))
-            start += n_block
-
-        H_sim = np.zeros((n_sim, len(sample_pts)), dtype=np.float32)
-
-        with ProcessPoolExecutor(max_workers=n_workers) as ex:
-            futs = [ex.submit(self._worker_sim_block, t) for t in tasks]
-            for fut in tqdm(as_completed(futs), total=len(futs), desc="Simulaciones HS (paralelo)"):
-                start_idx, block = fut.result()
-                H_sim[start_idx:start_idx + block.shape[0], :] = block
-
-        return H_sim.astype(float)
-
-    def longitud_geom_m_equivalente(self, geom, m_lat, m_lon):
-        if geom is None or geom.is_empty:
-            return 0.0
-        if geom.geom_type == "LineString":
-            return self.longitud_m_equivalente(geom, m_lat, m_lon)
-        if geom.geom_type == "MultiLineString":
-            return sum(self.longitud_m_equivalente(g, m_lat, m_lon) for g in geom.geoms)
-        return 0.0
-
-    def calcular_HS_UCL_LCL(self, H_obs, H_sim):
-        mean = H_sim.mean(axis=0)
-        HS = H_obs - mean
-        lo = np.quantile(H_sim, 0.025, axis=0)
-        hi = np.quantile(H_sim, 0.975, axis=0)
+    def calcular_HS_UCL_LCL(self, H_obs, env):
+        HS = H_obs - env.media()
+        lo, hi = env.cuantiles()
         return HS, hi, lo
 
-    pass
\ No newline at end of file
+    pass
+
+
+# ==================================================
+# ESTADO DE LA EJECUCION
+# ==================================================
+
+def guardar_estado(output_folder, estado):
+
+    # Escritura atómica: quien consulta nunca lee un JSON a medio escribir
+    estado = dict(estado, actualizado=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    path = os.path.join(output_folder, "status.json")
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(estado, f, indent=2)
+    os.replace(tmp, path)
+
+
+def leer_estado(output_folder):
+    path = os.path.join(output_folder, "status.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ==================================================
+# WORKERS CON MEMORIA COMPARTIDA
+# ==================================================
+
+# Estado de solo lectura de cada proceso worker, creado por el initializer
+_WORKER_RED = {}
+
+
+def _publicar_arreglos(arreglos):
+    bloques = []
+    specs = {}
+    for nombre, arr in arreglos.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        bloques.append(shm)
+        specs[nombre] = (shm.name, arr.shape, arr.dtype.str)
+    return bloques, specs
+
+
+def _liberar_arreglos(bloques):
+    for shm in bloques:
+        shm.close()
+        shm.unlink()
+
+
+def _inicializar_worker_red(specs, escalares):
+
+    _WORKER_RED.clear()
+    shms = []
+
+    for nombre, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shms.append(shm)
+        _WORKER_RED[nombre] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    _WORKER_RED["_shm"] = shms
+    _WORKER_RED.update(escalares)
+
+    # Geometrías y árbol reconstruidos una sola vez por worker
+    _WORKER_RED["geoms"] = shapely.linestrings(_WORKER_RED["seg_xy"], indices=_WORKER_RED["seg_idx"])
+    if "sample_xy" in _WORKER_RED:
+        _WORKER_RED["tree_muestras"] = cKDTree(_WORKER_RED["sample_xy"])
+    if _WORKER_RED.get("distance_mode") == "red":
+        _WORKER_RED["red"] = RedCSR(
+            _WORKER_RED["seg_xy"], _WORKER_RED["seg_idx"], _WORKER_RED["seg_lengths"],
+            _WORKER_RED["m_lat"], _WORKER_RED["m_lon"]
+        )
+
+    # Instancia sin estado, solo para reutilizar los métodos vectorizados
+    _WORKER_RED["kr"] = KRipley_HS.__new__(KRipley_HS)
+
+
+def _resultados_en_orden(ex, fn, tareas, ventana):
+
+    # Resultados en el orden de las tareas con a lo sumo `ventana` en vuelo:
+    # la acumulación es determinista y no se retienen bloques terminados
+    tareas = iter(tareas)
+    pendientes = deque(ex.submit(fn, *t) for _, t in zip(range(ventana), tareas))
+    while pendientes:
+        res = pendientes.popleft().result()
+        t = next(tareas, None)
+        if t is not None:
+            pendientes.append(ex.submit(fn, *t))
+        yield res
+
+
+def _worker_hs_bloque(start_idx, n_block, seed_seq):
+
+    w = _WORKER_RED
+    env = EnvolventeCuantiles(w["n_sim"], len(w["sample_xy"]))
+    parcial = w["kr"]._hs_bloque(
+        env, n_block, seed_seq,
+        w["seg_offsets"], w["seg_lengths"], w["breaks"], w["geoms"],
+        w["tree_muestras"], w["r_deg"], w["fac"], w["n_events"]
+    )
+    return start_idx, parcial
+
+
+def _worker_ripley_bloque(start_idx, n_block, seed_seq):
+
+    w = _WORKER_RED
+    block = w["kr"]._ripley_bloque(
+        n_block, w["n_events"], seed_seq,
+        w["seg_offsets"], w["seg_lengths"], w["breaks"], w["geoms"],
+        w["r_vals"], w["m_lat"], w["m_lon"], w["D"], w.get("red")
+    )
+    return start_idx, block
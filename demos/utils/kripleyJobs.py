@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os, logging, threading, traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+from .kripley02 import KRipley_HS, guardar_estado, leer_estado
+
+logger = logging.getLogger(__name__)
+
+# ==================================================
+# EJECUCION EN SEGUNDO PLANO DE KRIPLEY_HS
+# ==================================================
+
+# Un solo pool por proceso Django; cada corrida es un proceso aparte (spawn,
+# para no heredar hilos ni conexiones del servidor) que reporta su avance en
+# output_folder/status.json
+_EJECUTOR = None
+_LOCK = threading.Lock()
+
+
+def _ejecutor(max_jobs):
+    global _EJECUTOR
+    with _LOCK:
+        if _EJECUTOR is None:
+            _EJECUTOR = ProcessPoolExecutor(
+                max_workers=max(1, int(max_jobs)),
+                mp_context=mp.get_context("spawn")
+            )
+        return _EJECUTOR
+
+
+def _ejecutar_kripley(output_folder, args, kwargs):
+    try:
+        KRipley_HS(*args, **kwargs)
+    except Exception as e:
+        estado = leer_estado(output_folder) or {}
+        estado.update({
+            "estado": "error",
+            "detalle": str(e),
+            "traceback": traceback.format_exc()
+        })
+        guardar_estado(output_folder, estado)
+        raise
+
+
+def _al_terminar(output_folder):
+
+    def callback(fut):
+        global _EJECUTOR
+        exc = fut.exception()
+        if exc is None:
+            return
+        # Si el proceso murió (p. ej. sin memoria) el error no alcanzó a
+        # quedar en status.json y el pool queda inutilizable
+        estado = leer_estado(output_folder) or {}
+        if estado.get("estado") != "error":
+            estado.update({"estado": "error", "detalle": repr(exc)})
+            guardar_estado(output_folder, estado)
+        if type(exc).__name__ == "BrokenProcessPool":
+            with _LOCK:
+                _EJECUTOR = None
+
+    return callback
+
+
+def enviar_kripley(output_folder, args, kwargs, max_jobs=1):
+
+    # Encola la corrida y retorna de inmediato
+    os.makedirs(output_folder, exist_ok=True)
+    guardar_estado(output_folder, {
+        "estado": "en_cola",
+        "etapa": None,
+        "simulaciones_hechas": 0,
+        "simulaciones_total": None,
+        "porcentaje": 0.0
+    })
+
+    fut = _ejecutor(max_jobs).submit(_ejecutar_kripley, str(output_folder), tuple(args), dict(kwargs))
+    fut.add_done_callback(_al_terminar(str(output_folder)))
+    return fut
+
+
+def _precargar_eventos(excel_path, cache_folder, sheet, lat, lon):
+    KRipley_HS.__new__(KRipley_HS).cargar_eventos_excel(excel_path, sheet, lat, lon, cache_folder)
+
+
+def precargar_eventos(excel_path, cache_folder, sheet="SUKUBUN", lat="y", lon="x", max_jobs=1):
+
+    # Convierte el Excel recién subido a la cache Parquet en el mismo pool de
+    # las corridas, así el worker además lo deja en memoria
+    fut = _ejecutor(max_jobs).submit(_precargar_eventos, str(excel_path), str(cache_folder), sheet, lat, lon)
+    fut.add_done_callback(_reportar_error_precarga)
+    return fut
+
+
+def _reportar_error_precarga(fut):
+    if fut.exception() is not None:
+        logger.error("Error precargando eventos: %s", fut.exception())
+
+
+def listar_salidas(output_folder):
+
+    # Archivos ya escritos por la corrida (parciales mientras avanza)
+    if not os.path.isdir(output_folder):
+        return []
+    return sorted(
+        f for f in os.listdir(output_folder)
+        if f != "status.json" and not f.endswith(".tmp")
+    )
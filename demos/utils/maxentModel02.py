@@ -1,16 +1,32 @@
 import os
-import random
+import sys
+import json
+import time
+import uuid
+import hashlib
+import logging
+import tracemalloc
 import geopandas as gpd
 import numpy as np
+import shapely
 import pandas as pd
-from tqdm import tqdm
 from rasterio import open as rasterio_open
-from rasterio.mask import mask
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import Window
 from django.conf import settings
 
-from rpy2.robjects import r, globalenv
-from rpy2.robjects.packages import importr
-from rpy2.robjects.vectors import StrVector
+from rpy2.robjects import r, globalenv, default_converter
+from rpy2.robjects.vectors import StrVector, FloatVector
+from rpy2.robjects.conversion import localconverter
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from .rEntorno import preparar_entorno_r, pool_r, descartar_pool_r
+from .maxentPrediccion import predecir_raster, nombre_variable_r, extraer_valores
+from .maxentNativo import ajustar_maxent_nativo, separar_entrenamiento
+
+logger = logging.getLogger(__name__)
 
 
 # =====================================================
@@ -35,6 +51,11 @@ class MaxEntWorkflow:
         n_points=10000,
         training_prob=0.8,
         replicates=3,
+        seed=None,
+        n_workers=None,
+        output_format="cloglog",
+        engine=None,
+        medir_memoria_python=None,
     ):
         self.project_name = project_name
 
@@ -59,17 +80,224 @@ class MaxEntWorkflow:
         self.n_points = n_points
         self.training_prob = training_prob
         self.replicates = replicates
+        self.seed = seed
+        self.n_workers = n_workers or min(8, os.cpu_count() or 1)
+        self.output_format = output_format
+
+        # "r": dismo/maxent.jar vía rpy2; "python": motor NumPy (maxentNativo)
+        self.engine = engine or getattr(settings, "MAXENT_ENGINE", "r")
+
+        # Pico Python/NumPy por paso con tracemalloc: alarga bastante los pasos
+        # con muchas asignaciones, así que solo se mide si se pide
+        if medir_memoria_python is None:
+            medir_memoria_python = getattr(settings, "MAXENT_TRACEMALLOC", False)
+        self.medir_memoria_python = medir_memoria_python
+
+        # Coordenadas (x, y) del background de esta corrida
+        self.puntos_background = None
+
+        # Métricas de la última corrida (run_metrics.json)
+        self.metricas = {"pasos": {}}
 
     # =================================================
     def run(self):
-        print(f"\n=== Procesando región: {self.project_name} ===")
+        logger.info("Procesando región %s (motor %s)", self.project_name, self.engine)
+
+        # Tiempo, memoria y tamaño de salidas por paso en run_metrics.json
+        inicio = time.perf_counter()
+        self.metricas = {
+            "region": self.project_name,
+            "engine": self.engine,
+            "inicio": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "estado": "en_curso",
+            "pasos": {},
+        }
+        try:
+            self._ejecutar_pasos()
+            self.metricas["estado"] = "OK"
+        except Exception as e:
+            self.metricas["estado"] = "ERROR"
+            self.metricas["detalle"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.metricas["duracion_s"] = round(time.perf_counter() - inicio, 2)
+            self._guardar_json("run_metrics.json", self.metricas)
 
+        logger.info("Región %s completada en %.1f s", self.project_name, self.metricas["duracion_s"])
+        return self.metricas
+
+    # =================================================
+    def _ejecutar_pasos(self):
         self.preparar_carpetas()
-        self.recortar_rasteres()
-        self.generar_puntos_aleatorios()
-        self.ejecutar_maxent_en_r()
 
-        print(f"=== Región {self.project_name} completada ===")
+        # Cada paso se salta si sus entradas, parámetros y paso previo no
+        # cambiaron desde la última corrida y sus salidas siguen en disco
+        raster_dir = os.path.join(self.input_project_path, self.raster_folder)
+        shp_base = os.path.splitext(os.path.join(self.input_project_path, self.line_shp_name))[0]
+
+        h = self.ejecutar_paso(
+            "recorte",
+            self.recortar_rasteres,
+            entradas=[shp_base + ext for ext in (".shp", ".shx", ".dbf", ".prj", ".cpg")]
+            + [os.path.join(raster_dir, t) for t in os.listdir(raster_dir) if t.lower().endswith(".tif")],
+            params={"buffer_dist": self.buffer_dist, "simplify_factor": self.simplify_factor},
+            salidas=lambda: self._archivos_en(self.crop_folder, ".tif"),
+        )
+        h = self.ejecutar_paso(
+            "puntos",
+            self.generar_puntos_aleatorios,
+            previa=h,
+            params={"n_points": self.n_points, "seed": self.seed},
+            salidas=lambda: [self.output_sample_name],
+        )
+        h = self.ejecutar_paso(
+            "modelo",
+            self.ejecutar_maxent_python if self.engine == "python" else self.ejecutar_maxent_en_r,
+            previa=h,
+            entradas=[os.path.join(self.input_project_path, self.hotspot_filename)],
+            params={
+                "engine": self.engine,
+                "training_prob": self.training_prob,
+                "replicates": self.replicates,
+                "seed": self.seed,
+            },
+            salidas=lambda: self._archivos_en(self.output_folder, ".lambdas"),
+        )
+        self.ejecutar_paso(
+            "prediccion",
+            self.predecir_maxent,
+            previa=h,
+            params={"output_format": self.output_format},
+            salidas=lambda: [os.path.join(self.result_folder, "resultado_maxent.tif")],
+        )
+
+    # =================================================
+    # CACHE POR PASO (manifest.json de la región)
+    # =================================================
+    def ejecutar_paso(self, paso, funcion, previa=None, entradas=(), params=None, salidas=None):
+        manifiesto = self._leer_manifiesto()
+        hashes = manifiesto.setdefault("archivos", {})
+
+        h = hashlib.sha256(json.dumps([paso, previa]).encode())
+        for path in sorted(p for p in entradas if os.path.exists(p)):
+            h.update(os.path.basename(path).encode())
+            h.update(self._hash_archivo(path, hashes).encode())
+        h.update(json.dumps({k: repr(v) for k, v in (params or {}).items()}, sort_keys=True).encode())
+        huella = h.hexdigest()
+
+        previo = manifiesto.setdefault("pasos", {}).get(paso)
+        if (
+            previo
+            and previo["huella"] == huella
+            and previo["salidas"]
+            and all(os.path.exists(os.path.join(self.output_project_path, f)) for f in previo["salidas"])
+        ):
+            logger.info("[%s] %s: sin cambios, se reutilizan sus salidas", self.project_name, paso)
+            self._registrar_metrica(paso, {"estado": "cache", "duracion_s": 0.0}, previo["salidas"])
+            self._guardar_json("manifest.json", manifiesto)
+            return huella
+
+        # Salidas de la corrida anterior del paso: no deben mezclarse con las nuevas
+        for f in (previo or {}).get("salidas", []):
+            path = os.path.join(self.output_project_path, f)
+            if os.path.exists(path):
+                os.remove(path)
+
+        medicion = self._medir(paso, funcion)
+
+        manifiesto["pasos"][paso] = {
+            "huella": huella,
+            "salidas": sorted(salidas()) if salidas else [],
+            "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self._registrar_metrica(paso, medicion, manifiesto["pasos"][paso]["salidas"])
+        self._guardar_json("manifest.json", manifiesto)
+        return huella
+
+    # =================================================
+    # MÉTRICAS POR PASO (run_metrics.json de la región)
+    # =================================================
+    def _medir(self, paso, funcion):
+
+        # Duración, RSS máximo del proceso y cuánto lo subió el paso; con
+        # medir_memoria_python, además el pico Python/NumPy (tracemalloc; no
+        # incluye R, Java ni GDAL)
+        propio = False
+        if self.medir_memoria_python:
+            propio = not tracemalloc.is_tracing()
+            if propio:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        rss_inicio = _rss_max_mb()
+        inicio = time.perf_counter()
+        medicion = {"estado": "ejecutado"}
+
+        try:
+            resultado = funcion()
+            if isinstance(resultado, dict):
+                medicion["resultado"] = resultado
+        except Exception as e:
+            medicion["estado"] = "error"
+            medicion["detalle"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            medicion["duracion_s"] = round(time.perf_counter() - inicio, 3)
+            if self.medir_memoria_python:
+                medicion["pico_python_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                if propio:
+                    tracemalloc.stop()
+            medicion["rss_max_mb"] = _rss_max_mb()
+            if rss_inicio is not None:
+                medicion["rss_incremento_mb"] = round(medicion["rss_max_mb"] - rss_inicio, 1)
+            if medicion["estado"] == "error":
+                self._registrar_metrica(paso, medicion, [])
+            logger.info(
+                "[%s] %s: %s en %.2f s (RSS máx. %s MB)",
+                self.project_name, paso, medicion["estado"],
+                medicion["duracion_s"], medicion["rss_max_mb"],
+            )
+        return medicion
+
+    def _registrar_metrica(self, paso, medicion, salidas):
+        tamanos = [
+            os.path.getsize(os.path.join(self.output_project_path, f)) for f in salidas
+            if os.path.exists(os.path.join(self.output_project_path, f))
+        ]
+        medicion = dict(medicion, n_salidas=len(tamanos), mb_salidas=round(sum(tamanos) / 2**20, 2))
+        self.metricas["pasos"][paso] = medicion
+        self._guardar_json("run_metrics.json", self.metricas)
+
+    def _archivos_en(self, carpeta, extension):
+        path = os.path.join(self.output_project_path, carpeta)
+        return [os.path.join(carpeta, f) for f in os.listdir(path) if f.lower().endswith(extension)]
+
+    def _hash_archivo(self, path, hashes):
+        # sha256 del contenido; se recalcula solo si cambian tamaño o fecha
+        st = os.stat(path)
+        previo = hashes.get(path)
+        if previo and previo["size"] == st.st_size and previo["mtime_ns"] == st.st_mtime_ns:
+            return previo["sha256"]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for bloque in iter(lambda: f.read(1 << 20), b""):
+                h.update(bloque)
+        hashes[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": h.hexdigest()}
+        return hashes[path]["sha256"]
+
+    def _leer_manifiesto(self):
+        path = os.path.join(self.output_project_path, "manifest.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _guardar_json(self, nombre, datos):
+        # Escritura atómica, como status.json de kripley
+        path = os.path.join(self.output_project_path, nombre)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(datos, f, indent=2)
+        os.replace(tmp, path)
 
     # =================================================
     def preparar_carpetas(self):
@@ -86,46 +314,109 @@ class MaxEntWorkflow:
             raise FileNotFoundError(shp_path)
 
         lineas = gpd.read_file(shp_path).to_crs(epsg=3857)
-
-        buffer_geom = (
-            lineas.buffer(self.buffer_dist)
-            .union_all()
-            .simplify(self.simplify_factor, preserve_topology=True)
-        )
+        buffer_geom = self.construir_corredor(lineas.geometry)
 
         raster_dir = os.path.join(self.input_project_path, self.raster_folder)
         crop_dir = os.path.join(self.output_project_path, self.crop_folder)
 
-        for tif in os.listdir(raster_dir):
-            if not tif.lower().endswith(".tif"):
-                continue
+        tifs = sorted(t for t in os.listdir(raster_dir) if t.lower().endswith(".tif"))
 
+        # Rásteres con la misma grilla comparten geometría reproyectada y
+        # máscara rasterizada; se calculan una sola vez por grilla
+        mascaras = {}
+        tareas = []
+        for tif in tifs:
             with rasterio_open(os.path.join(raster_dir, tif)) as src:
-                geom = (
-                    gpd.GeoSeries([buffer_geom], crs="EPSG:3857")
-                    .to_crs(src.crs)
-                    .iloc[0]
+                clave = (src.crs.to_string() if src.crs else None, tuple(src.transform), src.width, src.height)
+                if clave not in mascaras:
+                    geom = (
+                        gpd.GeoSeries([buffer_geom], crs="EPSG:3857")
+                        .to_crs(src.crs)
+                        .iloc[0]
+                    )
+                    mascaras[clave] = raster_geometry_mask(src, [geom.__geo_interface__], crop=True)
+            tareas.append((tif, mascaras[clave]))
+
+        # rasterio libera el GIL al leer, comprimir y escribir: basta con hilos
+        with ThreadPoolExecutor(max_workers=max(1, int(self.n_workers))) as ex:
+            futuros = [
+                ex.submit(
+                    self._recortar_raster,
+                    os.path.join(raster_dir, tif),
+                    os.path.join(crop_dir, tif),
+                    *grilla,
                 )
+                for tif, grilla in tareas
+            ]
+            for fut in as_completed(futuros):
+                fut.result()
 
-                out_img, out_tr = mask(
-                    src,
-                    [geom.__geo_interface__],
-                    crop=True
-                )
+        logger.info("[%s] %d rásteres recortados", self.project_name, len(tareas))
 
-                meta = src.meta.copy()
-                meta.update(
-                    height=out_img.shape[1],
-                    width=out_img.shape[2],
-                    transform=out_tr,
-                )
+    # =================================================
+    def construir_corredor(self, lineas, tam_grupo=500):
+
+        # Se simplifican las líneas (no el polígono ya unido) antes del buffer:
+        # menos vértices en cada buffer y en todas las uniones
+        geoms = shapely.simplify(lineas.values, self.simplify_factor)
+        geoms = geoms[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))]
+        if not len(geoms):
+            raise RuntimeError("La capa de vías no tiene geometrías")
+
+        # Grupos de líneas vecinas (orden de Hilbert): cada grupo se une por
+        # separado y los resultados se unen de a pares. shapely libera el GIL
+        # en buffer/union, así que los grupos corren en hilos
+        orden = np.argsort(gpd.GeoSeries(geoms).hilbert_distance().to_numpy(), kind="stable")
+        grupos = np.array_split(orden, -(-len(orden) // tam_grupo))
+
+        def unir_grupo(idx):
+            # Simplificado por grupo: las uniones de a pares y la máscara
+            # trabajan con menos vértices
+            union = shapely.union_all(shapely.buffer(geoms[idx], self.buffer_dist))
+            return union.simplify(self.simplify_factor, preserve_topology=True)
+
+        with ThreadPoolExecutor(max_workers=max(1, int(self.n_workers))) as ex:
+            partes = list(ex.map(unir_grupo, grupos))
+            while len(partes) > 1:
+                pares = list(ex.map(shapely.union, partes[0::2], partes[1::2]))
+                partes = pares + partes[len(pares) * 2:]
+
+        return partes[0]
 
-                with rasterio_open(
-                    os.path.join(crop_dir, tif),
-                    "w",
-                    **meta
-                ) as dst:
-                    dst.write(out_img)
+    # =================================================
+    def _recortar_raster(self, src_path, dst_path, fuera, out_tr, ventana):
+
+        # Escritura bloque a bloque: nunca se lee el recorte completo
+        with rasterio_open(src_path) as src:
+            nodata = src.nodata if src.nodata is not None else 0
+
+            meta = src.profile.copy()
+            meta.update(
+                driver="GTiff",
+                height=fuera.shape[0],
+                width=fuera.shape[1],
+                transform=out_tr,
+                tiled=True,
+                blockxsize=256,
+                blockysize=256,
+                compress="deflate",
+                BIGTIFF="IF_SAFER",
+            )
+
+            row0 = int(ventana.row_off)
+            col0 = int(ventana.col_off)
+
+            with rasterio_open(dst_path, "w", **meta) as dst:
+                for _, w in dst.block_windows(1):
+                    r0, c0 = int(w.row_off), int(w.col_off)
+                    r1, c1 = r0 + int(w.height), c0 + int(w.width)
+
+                    datos = src.read(
+                        window=Window(col0 + c0, row0 + r0, w.width, w.height),
+                        masked=True,
+                    )
+                    datos.mask = datos.mask | fuera[r0:r1, c0:c1]
+                    dst.write(datos.filled(nodata), window=w)
 
     # =================================================
     def generar_puntos_aleatorios(self):
@@ -135,15 +426,39 @@ class MaxEntWorkflow:
         if not raster_files:
             raise RuntimeError("No hay rásteres recortados")
 
-        with rasterio_open(os.path.join(crop_dir, raster_files[0])) as src:
-            arr = src.read(1)
-            valid = np.where(arr != src.nodata)
-
-            n = min(self.n_points, len(valid[0]))
-            idx = random.sample(list(zip(valid[0], valid[1])), n)
-            xy = [src.xy(r, c) for r, c in idx]
+        rng = np.random.default_rng(self.seed)
 
-        df = pd.DataFrame(xy, columns=["x", "y"])
+        with rasterio_open(os.path.join(crop_dir, raster_files[0])) as src:
+            # Dos pasadas por bloques, sin cargar el ráster completo:
+            # 1) cuántos píxeles válidos hay en cada bloque
+            ventanas = [w for _, w in src.block_windows(1)]
+            conteo = np.array([
+                np.count_nonzero(src.read_masks(1, window=w)) for w in ventanas
+            ], dtype=np.int64)
+            inicio = np.concatenate([[0], np.cumsum(conteo)])
+
+            # 2) índices planos sobre el total de válidos, ubicados por bloque
+            n = int(min(self.n_points, inicio[-1]))
+            elegidos = np.sort(rng.choice(inicio[-1], size=n, replace=False))
+            bloque = np.searchsorted(inicio, elegidos, side="right") - 1
+
+            filas, cols = [], []
+            for b in np.unique(bloque):
+                w = ventanas[b]
+                validos = np.flatnonzero(src.read_masks(1, window=w))
+                pos = validos[elegidos[bloque == b] - inicio[b]]
+                filas.append(w.row_off + pos // w.width)
+                cols.append(w.col_off + pos % w.width)
+
+            filas = np.concatenate(filas) if filas else np.zeros(0, dtype=np.int64)
+            cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+
+            # Centro de cada píxel con la transformación afín, vectorizada
+            x, y = src.transform * (cols + 0.5, filas + 0.5)
+
+        self.puntos_background = (x, y)
+
+        df = pd.DataFrame({"x": x, "y": y})
         df.to_csv(
             os.path.join(self.output_project_path, self.output_sample_name),
             index=False,
@@ -152,67 +467,40 @@ class MaxEntWorkflow:
     # =================================================
     def ejecutar_maxent_en_r(self):
 
+        # Paquetes y JVM: una sola vez por proceso, sin red
+        preparar_entorno_r(
+            getattr(settings, "R_LIBRARY_PATH", None),
+            getattr(settings, "R_REPO_LOCAL", None),
+            getattr(settings, "MAXENT_WORKER_MEMORY_MB", None),
+        )
+
+        muestras = self.extraer_muestras()
+        nombres = muestras["nombres"]
 
-        # Preparar CRAN y paquetes
-        utils = importr("utils")
-        utils.chooseCRANmirror(ind=1)
-        paquetes = ["raster", "dismo", "readr", "sp", "sf", "codetools", "rJava"]
-        utils.install_packages(StrVector(paquetes))
+        # Entrenamiento / prueba en Python (misma regla que el motor NumPy)
+        rng = np.random.default_rng(self.seed)
+        sel = separar_entrenamiento(len(muestras["occ"]), self.training_prob, rng)
+        p = muestras["occ"][sel]
+        a = muestras["bg"]
 
-        # Variables de entorno
+        # Matrices de valores directo a R, por columnas; NaN llega como NA
         globalenv["basepath"] = self.output_project_path.replace("\\", "/")
-        globalenv["cropFolder"] = self.crop_folder
         globalenv["outputFolder"] = self.output_folder
-        globalenv["resultFolder"] = self.result_folder
-        globalenv["hotspot"] = os.path.join(self.input_project_path, self.hotspot_filename).replace("\\", "/")
-        globalenv["outputSample"] = self.output_sample_name
-        globalenv["trainingProb"] = self.training_prob
+        globalenv["varNames"] = StrVector(nombres)
+        globalenv["pVals"] = FloatVector(p.ravel(order="F").astype(float).tolist())
+        globalenv["aVals"] = FloatVector(a.ravel(order="F").astype(float).tolist())
         globalenv["replicates"] = self.replicates
 
         # Código R
         script_r = """
-        library(raster)
-        library(dismo)
-        library(readr)
-        library(sp)
-        library(sf)
-        library(codetools)
-        library(rJava)
-        .jinit()
-
         .jcall("java/lang/System", "S", "getProperty", "java.version")
 
         setwd(basepath)
-        crop_path   <- file.path(basepath, cropFolder)
         output_path <- file.path(basepath, outputFolder)
-        result_path <- file.path(basepath, resultFolder)
-
-        raster_files <- list.files(crop_path, pattern="\\\\.tif$", full.names=TRUE)
-        if (length(raster_files) == 0) stop("No hay rásteres recortados")
 
-        clim <- stack(raster_files)
-
-        # Background
-        bg <- read_csv(file.path(basepath, outputSample))
-        coordinates(bg) <- ~x + y
-
-        # Ocurrencias
-        occ_raw <- read_csv(hotspot)
-        occ_clean <- occ_raw[!is.na(occ_raw$Longitude) & !is.na(occ_raw$Latitude), ]
-        occ_clean <- occ_clean[!duplicated(occ_clean[c("Longitude","Latitude")]), ]
-        coordinates(occ_clean) <- ~Longitude + Latitude
-
-        n <- nrow(occ_clean)
-        if (n < 5) stop("Muy pocos puntos de ocurrencia")
-
-        # Selección entrenamiento
-        sel <- sample(1:n, round(n * trainingProb))
-        occ_train <- occ_clean[sel, ]
-        occ_test  <- occ_clean[-sel, ]
-
-        # Extraer valores de raster para presencia y background
-        p <- extract(clim, occ_train)
-        a <- extract(clim, bg)
+        # Valores de presencia y background ya extraídos en Python
+        p <- matrix(pVals, ncol = length(varNames), dimnames = list(NULL, varNames))
+        a <- matrix(aVals, ncol = length(varNames), dimnames = list(NULL, varNames))
         pa <- c(rep(1, nrow(p)), rep(0, nrow(a)))
         pder <- as.data.frame(rbind(p, a))
 
@@ -224,17 +512,200 @@ class MaxEntWorkflow:
             args = c("autofeature", "responsecurves", "jackknife",
                     paste0("replicates=", replicates))
         )
-
-        # Predicción
-        pred <- predict(mod, clim)
-        writeRaster(pred, filename=file.path(result_path, "resultado_maxent.tif"), overwrite=TRUE)
         """
 
+        # Un error de R debe marcar la región como fallida
         try:
             r(script_r)
-            print(f"[OK] MaxEnt ejecutado para {self.project_name}")
         except Exception as e:
-            print(f"[ERROR] Error en ejecución R ({self.project_name}): {e}")
+            raise RuntimeError(f"Error en ejecución R ({self.project_name}): {e}") from e
+
+        output_dir = os.path.join(self.output_project_path, self.output_folder)
+        if not any(f.endswith(".lambdas") for f in os.listdir(output_dir)):
+            raise RuntimeError(f"maxent no generó modelos .lambdas ({self.project_name})")
+
+        return {"n_presencias": int(len(p)), "n_background": int(len(a))}
+
+
+    # =================================================
+    def ejecutar_maxent_python(self):
+
+        # Mismas muestras que el script R, sin R ni JVM: ajuste y .lambdas
+        # en output
+        muestras = self.extraer_muestras()
+
+        resumen = ajustar_maxent_nativo(
+            muestras["occ"],
+            muestras["bg"],
+            muestras["nombres"],
+            os.path.join(self.output_project_path, self.output_folder),
+            training_prob=self.training_prob,
+            replicates=self.replicates,
+            seed=self.seed,
+            n_workers=self.n_workers,
+        )
+        logger.info("[%s] AUC de prueba (media de réplicas): %s", self.project_name, resumen["auc_prueba_media"])
+        return resumen
+
+    # =================================================
+    def extraer_muestras(self):
+
+        # Valores del stack recortado en presencias y background, como
+        # matrices float32 (una columna por ráster, nombres como raster::stack)
+        crop_dir = os.path.join(self.output_project_path, self.crop_folder)
+        rasters = sorted(
+            os.path.join(crop_dir, f) for f in os.listdir(crop_dir)
+            if f.lower().endswith(".tif")
+        )
+        if not rasters:
+            raise RuntimeError("No hay rásteres recortados")
+
+        # Background: el de generar_puntos_aleatorios si sigue en memoria
+        if self.puntos_background is not None:
+            bg_x, bg_y = self.puntos_background
+        else:
+            bg = pd.read_csv(os.path.join(self.output_project_path, self.output_sample_name))
+            bg_x, bg_y = bg["x"].to_numpy(), bg["y"].to_numpy()
+
+        occ = pd.read_csv(os.path.join(self.input_project_path, self.hotspot_filename))
+        occ = (
+            occ.dropna(subset=["Longitude", "Latitude"])
+            .drop_duplicates(subset=["Longitude", "Latitude"])
+        )
+        if len(occ) < 5:
+            raise RuntimeError("Muy pocos puntos de ocurrencia")
+
+        return {
+            "nombres": [nombre_variable_r(p) for p in rasters],
+            "occ": extraer_valores(rasters, occ["Longitude"], occ["Latitude"], self.n_workers),
+            "bg": extraer_valores(rasters, bg_x, bg_y, self.n_workers),
+        }
+
+    # =================================================
+    def predecir_maxent(self):
+
+        # R solo ajusta y deja los .lambdas; la predicción se hace por bloques
+        # del stack recortado, repartidos entre procesos
+        output_dir = os.path.join(self.output_project_path, self.output_folder)
+        crop_dir = os.path.join(self.output_project_path, self.crop_folder)
+        result_dir = os.path.join(self.output_project_path, self.result_folder)
+
+        lambdas = [
+            os.path.join(output_dir, f) for f in os.listdir(output_dir)
+            if f.endswith(".lambdas")
+        ]
+        rasters = sorted(
+            os.path.join(crop_dir, f) for f in os.listdir(crop_dir)
+            if f.lower().endswith(".tif")
+        )
+
+        predecir_raster(
+            lambdas,
+            rasters,
+            os.path.join(result_dir, "resultado_maxent.tif"),
+            salida=self.output_format,
+            n_workers=self.n_workers,
+        )
+
+
+# =====================================================
+# EJECUCIÓN EN EL WORKER R
+# =====================================================
+def ejecutar_region_maxent(project_name, input_basepath=None, output_basepath=None):
+    # Corre dentro de un proceso worker de rEntorno (R y JVM ya cargados,
+    # salvo con el motor NumPy)
+    inicio = time.time()
+    wf = MaxEntWorkflow(
+        project_name=project_name,
+        input_basepath=input_basepath,
+        output_basepath=output_basepath,
+    )
+    with localconverter(default_converter):
+        metricas = wf.run()
+    return {"pid": os.getpid(), "duracion_s": round(time.time() - inicio, 2), "metricas": metricas}
+
+
+def pool_regiones_maxent():
+    return pool_r(
+        getattr(settings, "R_LIBRARY_PATH", None),
+        getattr(settings, "R_REPO_LOCAL", None),
+        getattr(settings, "MAXENT_MAX_WORKERS", 1),
+        getattr(settings, "MAXENT_WORKER_MEMORY_MB", None),
+        preparar_r=getattr(settings, "MAXENT_ENGINE", "r") != "python",
+    )
+
+
+def ejecutar_regiones_maxent(regiones, input_basepath=None, output_basepath=None):
+
+    # Hasta MAXENT_MAX_WORKERS regiones a la vez, cada una en su propio
+    # proceso con su R; devuelve estado y tiempos por región.
+    # Si un worker muere, el pool falla todas sus tareas pendientes sin
+    # indicar cuál lo tumbó: las regiones sin terminar se reintentan de a una
+    # en un pool nuevo y solo la que vuelve a tumbarlo queda en error
+    inicio = time.time()
+    estado = {}
+
+    def registrar(region, info):
+        if info["estado"] == "ERROR":
+            # Lo que alcanzó a medir el worker antes del fallo
+            info["metricas"] = leer_metricas_region(region, output_basepath)
+        info["fin_s"] = round(time.time() - inicio, 2)
+        estado[region] = info
+        logger.log(
+            logging.INFO if info["estado"] == "OK" else logging.ERROR,
+            "[%s] Región %s (%s s)", info["estado"], region, info["fin_s"],
+        )
+
+    def resultado(fut):
+        try:
+            return {"estado": "OK", **fut.result()}
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            return {"estado": "ERROR", "detalle": f"{type(e).__name__}: {e}"}
+
+    # Todas en paralelo
+    pool = pool_regiones_maxent()
+    futuros = {pool.submit(ejecutar_region_maxent, region, input_basepath, output_basepath): region for region in regiones}
+    sin_terminar = []
+    for fut in as_completed(futuros):
+        try:
+            registrar(futuros[fut], resultado(fut))
+        except BrokenProcessPool:
+            sin_terminar.append(futuros[fut])
+
+    # Tras una caída: de a una, para aislar la región que tumba el worker
+    if sin_terminar:
+        descartar_pool_r(pool)
+        logger.warning("Un worker R terminó de forma inesperada; se reintentan de a una: %s", ", ".join(sin_terminar))
+    for region in [r for r in regiones if r in sin_terminar]:
+        pool = pool_regiones_maxent()
+        try:
+            registrar(region, resultado(pool.submit(ejecutar_region_maxent, region, input_basepath, output_basepath)))
+        except BrokenProcessPool as e:
+            descartar_pool_r(pool)
+            registrar(region, {"estado": "ERROR", "detalle": f"El worker R terminó de forma inesperada: {e}"})
+
+    return {region: estado[region] for region in regiones}
+
+
+def leer_metricas_region(project_name, output_basepath=None):
+    output_basepath = output_basepath or os.path.join(settings.MEDIA_ROOT, "maxent_invias")
+    path = os.path.join(output_basepath, project_name, "run_metrics.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _rss_max_mb():
+    # Pico de memoria residente del proceso (POSIX); no disponible en Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
 
 
 # =====================================================
@@ -252,13 +723,7 @@ def run_maxent_desde_jacknife():
     if not regiones:
         raise RuntimeError("No hay regiones en jacknife")
 
-    for region in regiones:
-        wf = MaxEntWorkflow(
-            project_name=region,
-            input_basepath=jacknife_root,
-            output_basepath=output_root,
-        )
-        wf.run()
+    return ejecutar_regiones_maxent(regiones, jacknife_root, output_root)
 
 
 # =====================================================
@@ -0,0 +1,400 @@
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+# =====================================================
+# MOTOR MAXENT EN NUMPY
+# =====================================================
+# Alternativa a dismo/maxent.jar: mismas muestras de presencia y background,
+# features lineales, cuadráticas, producto y hinge escaladas a [0, 1],
+# regularización L1 como maxent y salida en el formato .lambdas, de modo que
+# la predicción usa el mismo código (maxentPrediccion) que el modelo de R.
+#
+# Diferencia con maxent: maxent considera un nudo hinge en cada valor
+# distinto de la variable; aquí se usan n_nudos cuantiles interiores (20 por
+# defecto). Con muchas presencias las curvas de respuesta quedan algo más
+# suaves; no hay features threshold.
+
+# Regularización por defecto de maxent: beta según el número de presencias,
+# interpolado linealmente entre los puntos de la tabla. Las features
+# lineales, cuadráticas y producto usan todas una misma tabla, la de la clase
+# más compleja activa (producto > cuadrática > lineal); las hinge la suya
+REGULARIZACION = {
+    "lineal": ([0, 10, 30, 100], [1.0, 1.0, 0.2, 0.05]),
+    "cuadratica": ([0, 10, 17, 30, 100], [1.3, 0.8, 0.5, 0.25, 0.05]),
+    "producto": ([0, 10, 17, 30, 100], [2.6, 1.6, 0.9, 0.55, 0.05]),
+    "hinge": ([0, 1], [0.5, 0.5]),
+}
+
+# Autofeature: mínimo de presencias para activar cada tipo
+MIN_PRESENCIAS = {"lineal": 0, "cuadratica": 10, "hinge": 15, "producto": 80}
+
+
+# =====================================================
+# FEATURES
+# =====================================================
+class ExpansionFeatures:
+
+    # Define las features a partir de todas las muestras (presencias y
+    # background) y las evalúa de forma vectorizada. Cada feature se guarda
+    # como en el .lambdas: nombre, mínimo y máximo de escalado
+    def __init__(self, X, nombres, tipos, n_nudos=20):
+        n_var = X.shape[1]
+        self.nombres_var = list(nombres)
+        self.clases = list(tipos)
+        self.nombres = []
+        self.tipos = []
+        self.min = []
+        self.max = []
+
+        # Lineal, cuadrática y producto: columna a por columna b (b = n_var es
+        # una columna de unos)
+        self.a, self.b = [], []
+        pares = []
+        if "lineal" in tipos:
+            pares += [(i, n_var, nombres[i], "lineal") for i in range(n_var)]
+        if "cuadratica" in tipos:
+            pares += [(i, i, f"{nombres[i]}^2", "cuadratica") for i in range(n_var)]
+        if "producto" in tipos:
+            pares += [
+                (i, j, f"{nombres[i]}*{nombres[j]}", "producto")
+                for i in range(n_var) for j in range(i + 1, n_var)
+            ]
+
+        Xe = np.column_stack([X, np.ones(len(X))])
+        for i, j, nombre, tipo in pares:
+            crudo = Xe[:, i] * Xe[:, j]
+            mn, mx = float(crudo.min()), float(crudo.max())
+            if mx > mn:
+                self.a.append(i)
+                self.b.append(j)
+                self._agregar(nombre, tipo, mn, mx)
+        self.n_producto = len(self.nombres)
+
+        # Hinge directa (x > nudo) e inversa (x < nudo) en cuantiles interiores
+        self.h_var, self.h_nudo, self.h_inversa = [], [], []
+        if "hinge" in tipos:
+            for i in range(n_var):
+                mn, mx = float(X[:, i].min()), float(X[:, i].max())
+                if mx <= mn:
+                    continue
+                nudos = np.unique(np.quantile(X[:, i], np.linspace(0, 1, n_nudos + 2)[1:-1]))
+                for k in nudos[(nudos > mn) & (nudos < mx)]:
+                    self.h_var += [i, i]
+                    self.h_nudo += [float(k), float(k)]
+                    self.h_inversa += [False, True]
+                    self._agregar(f"'{nombres[i]}", "hinge", float(k), mx)
+                    self._agregar(f"`{nombres[i]}", "hinge", mn, float(k))
+
+        self.a = np.array(self.a, dtype=int)
+        self.b = np.array(self.b, dtype=int)
+        self.h_var = np.array(self.h_var, dtype=int)
+        self.h_nudo = np.array(self.h_nudo)
+        self.h_inversa = np.array(self.h_inversa, dtype=bool)
+        self.min = np.array(self.min)
+        self.max = np.array(self.max)
+
+    def _agregar(self, nombre, tipo, mn, mx):
+        self.nombres.append(nombre)
+        self.tipos.append(tipo)
+        self.min.append(mn)
+        self.max.append(mx)
+
+    def __len__(self):
+        return len(self.nombres)
+
+    def transformar(self, X):
+
+        # (n, n_features) en [0, 1], con clamping fuera del rango de escalado
+        Xe = np.column_stack([X, np.ones(len(X))])
+        p = self.n_producto
+        F = np.empty((len(X), len(self)))
+
+        F[:, :p] = (Xe[:, self.a] * Xe[:, self.b] - self.min[:p]) / (self.max[:p] - self.min[:p])
+
+        x = X[:, self.h_var]
+        rango = self.max[p:] - self.min[p:]
+        F[:, p:] = np.where(
+            self.h_inversa,
+            np.maximum(0.0, self.h_nudo - x),
+            np.maximum(0.0, x - self.h_nudo),
+        ) / rango
+
+        return np.clip(F, 0.0, 1.0, out=F)
+
+
+# =====================================================
+# AJUSTE (L1 CON DESCENSO PROXIMAL ACELERADO)
+# =====================================================
+def _logsumexp(s):
+    m = s.max()
+    return m + np.log(np.exp(s - m).sum())
+
+
+def ajustar_lambdas(F_pres, F_bg, betas, max_iter=1000, tol=1e-7):
+
+    # Minimiza -mean(F_pres) · l + log sum(exp(F_bg · l)) + sum(betas |l|),
+    # la pérdida regularizada de maxent, con FISTA y paso por backtracking
+    mu = F_pres.mean(axis=0)
+
+    def perdida(l):
+        s = F_bg @ l
+        lse = _logsumexp(s)
+        p = np.exp(s - lse)
+        return lse - mu @ l, F_bg.T @ p - mu
+
+    lam = np.zeros(F_bg.shape[1])
+    y = lam.copy()
+    t = 1.0
+    L = 1.0
+    obj_ant = np.inf
+
+    for _ in range(max_iter):
+        g_y, grad_y = perdida(y)
+        while True:
+            z = y - grad_y / L
+            z = np.sign(z) * np.maximum(np.abs(z) - betas / L, 0.0)
+            g_z, _ = perdida(z)
+            d = z - y
+            if g_z <= g_y + grad_y @ d + 0.5 * L * (d @ d) + 1e-12:
+                break
+            L *= 2.0
+
+        obj = g_z + betas @ np.abs(z)
+
+        # Reinicio si el objetivo sube (FISTA no es monótono)
+        if obj > obj_ant:
+            y = lam.copy()
+            t = 1.0
+            continue
+
+        t_sig = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t * t))
+        y = z + ((t - 1.0) / t_sig) * (z - lam)
+        lam, t = z, t_sig
+        L = max(L / 1.5, 1e-6)
+
+        if abs(obj_ant - obj) <= tol * max(1.0, abs(obj)):
+            break
+        obj_ant = obj
+
+    return lam
+
+
+def ganancia(lam, F_pres, F_bg):
+    # Ganancia de maxent: log-verosimilitud media respecto a la uniforme
+    return float(F_pres.mean(axis=0) @ lam - _logsumexp(F_bg @ lam) + np.log(len(F_bg)))
+
+
+def auc(pres, bg):
+    # Probabilidad de que una presencia puntúe más que un punto de background
+    if not len(pres) or not len(bg):
+        return float("nan")
+    bg = np.sort(bg)
+    menores = np.searchsorted(bg, pres, side="left")
+    iguales = np.searchsorted(bg, pres, side="right") - menores
+    return float((menores + 0.5 * iguales).sum() / (len(pres) * len(bg)))
+
+
+def tipos_autofeature(n_presencias):
+    return [t for t, n in MIN_PRESENCIAS.items() if n_presencias >= n]
+
+
+def betas_features(expansion, F_pres, multiplicador=1.0):
+
+    # beta_j = multiplicador * beta(tabla, m) * sd_j / sqrt(m), como maxent
+    m = len(F_pres)
+    sd = np.maximum(F_pres.std(axis=0), 0.001)
+
+    tabla = next(
+        (t for t in ("producto", "cuadratica") if t in expansion.clases),
+        "lineal",
+    )
+    beta_lqp = np.interp(m, *REGULARIZACION[tabla])
+    beta_hinge = np.interp(m, *REGULARIZACION["hinge"])
+    base = np.array([beta_hinge if t == "hinge" else beta_lqp for t in expansion.tipos])
+    return multiplicador * base * sd / np.sqrt(m)
+
+
+# =====================================================
+# MODELO
+# =====================================================
+def ajustar_modelo(X_pres, X_bg, nombres, multiplicador=1.0, n_nudos=20):
+
+    # Como maxent (addsamplestobackground) las presencias también entran
+    # al background
+    X_todas = np.vstack([X_bg, X_pres])
+    expansion = ExpansionFeatures(X_todas, nombres, tipos_autofeature(len(X_pres)), n_nudos)
+
+    F_pres = expansion.transformar(X_pres)
+    F_bg = expansion.transformar(X_todas)
+    lam = ajustar_lambdas(F_pres, F_bg, betas_features(expansion, F_pres, multiplicador))
+
+    s = F_bg @ lam
+    lpn = float(s.max())
+    dn = float(np.exp(s - lpn).sum())
+    p = np.exp(s - lpn) / dn
+    entropia = float(-(p[p > 0] * np.log(p[p > 0])).sum())
+
+    return {
+        "expansion": expansion,
+        "lambdas": lam,
+        "linearPredictorNormalizer": lpn,
+        "densityNormalizer": dn,
+        "numBackgroundPoints": len(F_bg),
+        "entropy": entropia,
+        "ganancia": ganancia(lam, F_pres, F_bg),
+    }
+
+
+def puntaje(modelo, X):
+    # Predictor lineal; monótono con la salida raw/logistic/cloglog
+    return modelo["expansion"].transformar(X) @ modelo["lambdas"]
+
+
+def escribir_lambdas(modelo, path):
+    e = modelo["expansion"]
+    with open(path, "w", encoding="utf-8") as f:
+        for nombre, lam, mn, mx in zip(e.nombres, modelo["lambdas"], e.min, e.max):
+            f.write(f"{nombre}, {float(lam)!r}, {float(mn)!r}, {float(mx)!r}\n")
+        for clave in ("linearPredictorNormalizer", "densityNormalizer", "numBackgroundPoints", "entropy"):
+            f.write(f"{clave}, {modelo[clave]}\n")
+
+
+# =====================================================
+# RÉPLICAS Y JACKKNIFE EN PARALELO
+# =====================================================
+def _ajustar_tarea(tarea, X_pres, X_bg, nombres, X_test, opciones):
+    cols = tarea["variables"]
+    pres = X_pres[tarea["entrenamiento"]][:, cols]
+    prueba = X_pres[tarea["prueba"]][:, cols] if len(tarea["prueba"]) else X_test[:, cols]
+    bg = X_bg[:, cols]
+
+    modelo = ajustar_modelo(pres, bg, [nombres[c] for c in cols], **opciones)
+
+    X_todas = np.vstack([bg, pres])
+    F_todas = modelo["expansion"].transformar(X_todas)
+    F_prueba = modelo["expansion"].transformar(prueba)
+    bg_puntaje = F_todas[: len(bg)] @ modelo["lambdas"]
+
+    resultado = {
+        "etiqueta": tarea["etiqueta"],
+        "ganancia_entrenamiento": modelo["ganancia"],
+        "ganancia_prueba": ganancia(modelo["lambdas"], F_prueba, F_todas) if len(prueba) else float("nan"),
+        "auc_entrenamiento": auc(F_todas[len(bg):] @ modelo["lambdas"], bg_puntaje),
+        "auc_prueba": auc(F_prueba @ modelo["lambdas"], bg_puntaje),
+        "n_features": int(np.count_nonzero(modelo["lambdas"])),
+    }
+    if tarea.get("lambdas_path"):
+        escribir_lambdas(modelo, tarea["lambdas_path"])
+    return resultado
+
+
+def separar_entrenamiento(n, training_prob, rng):
+    # Máscara de presencias de entrenamiento; el resto queda para prueba
+    sel = np.zeros(n, dtype=bool)
+    sel[rng.choice(n, int(round(n * training_prob)), replace=False)] = True
+    return sel
+
+
+def ajustar_maxent_nativo(
+    X_occ,
+    X_bg,
+    nombres,
+    output_dir,
+    training_prob=0.8,
+    replicates=1,
+    seed=None,
+    n_workers=None,
+    jackknife=True,
+    multiplicador=1.0,
+    n_nudos=20,
+):
+    rng = np.random.default_rng(seed)
+
+    # dismo descarta las filas con NA en alguna variable
+    X_occ = X_occ[np.isfinite(X_occ).all(axis=1)]
+    X_bg = X_bg[np.isfinite(X_bg).all(axis=1)]
+
+    n = len(X_occ)
+    if n < 5:
+        raise RuntimeError("Muy pocos puntos de ocurrencia")
+    if not len(X_bg):
+        raise RuntimeError("No hay puntos de background con valores en todos los rásteres")
+
+    sel = separar_entrenamiento(n, training_prob, rng)
+    X_pres, X_test = X_occ[sel], X_occ[~sel]
+
+    todas = list(range(len(nombres)))
+    idx = np.arange(len(X_pres))
+    sin_prueba = np.zeros(0, dtype=int)
+
+    # Réplicas por validación cruzada sobre las presencias de entrenamiento
+    # (replicatetype=crossvalidate de maxent); cada una deja su .lambdas
+    for f in os.listdir(output_dir):
+        if f.endswith(".lambdas"):
+            os.remove(os.path.join(output_dir, f))
+
+    tareas = []
+    if replicates > 1:
+        pliegues = np.array_split(rng.permutation(idx), replicates)
+        for i, pliegue in enumerate(pliegues):
+            tareas.append({
+                "etiqueta": f"replica_{i}",
+                "variables": todas,
+                "entrenamiento": np.setdiff1d(idx, pliegue),
+                "prueba": pliegue,
+                "lambdas_path": os.path.join(output_dir, f"species_{i}.lambdas"),
+            })
+    else:
+        tareas.append({
+            "etiqueta": "replica_0",
+            "variables": todas,
+            "entrenamiento": idx,
+            "prueba": sin_prueba,
+            "lambdas_path": os.path.join(output_dir, "species.lambdas"),
+        })
+
+    # Jackknife sobre el modelo completo: solo cada variable y sin ella
+    if jackknife and len(nombres) > 1:
+        tareas.append({"etiqueta": "todas", "variables": todas, "entrenamiento": idx, "prueba": sin_prueba})
+        for c in todas:
+            tareas.append({"etiqueta": f"solo:{nombres[c]}", "variables": [c], "entrenamiento": idx, "prueba": sin_prueba})
+            tareas.append({
+                "etiqueta": f"sin:{nombres[c]}",
+                "variables": [k for k in todas if k != c],
+                "entrenamiento": idx,
+                "prueba": sin_prueba,
+            })
+
+    opciones = {"multiplicador": multiplicador, "n_nudos": n_nudos}
+    args = (X_pres, X_bg, list(nombres), X_test, opciones)
+    n_workers = max(1, int(n_workers or min(8, os.cpu_count() or 1)))
+
+    if n_workers == 1 or len(tareas) == 1:
+        resultados = [_ajustar_tarea(t, *args) for t in tareas]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(n_workers, len(tareas)),
+            mp_context=mp.get_context("spawn"),
+        ) as ex:
+            resultados = list(ex.map(_ajustar_tarea, tareas, *[[a] * len(tareas) for a in args]))
+
+    # Resúmenes en la carpeta de salida, junto a los .lambdas
+    df = pd.DataFrame(resultados)
+    replicas = df[df["etiqueta"].str.startswith("replica_")]
+    replicas.to_csv(os.path.join(output_dir, "resultados_replicas.csv"), index=False)
+
+    jk = df[~df["etiqueta"].str.startswith("replica_")]
+    if len(jk):
+        jk.to_csv(os.path.join(output_dir, "jackknife.csv"), index=False)
+
+    return {
+        "n_presencias": int(len(X_pres)),
+        "n_prueba": int(len(X_test)),
+        "n_background": int(len(X_bg)),
+        "auc_prueba_media": None if replicas["auc_prueba"].isna().all() else float(replicas["auc_prueba"].mean()),
+    }
@@ -0,0 +1,291 @@
+import os
+import re
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from rasterio import open as rasterio_open
+from rasterio.windows import Window
+
+
+# =====================================================
+# MODELO MAXENT DESDE ARCHIVO .lambdas
+# =====================================================
+class ModeloLambdas:
+
+    # Modelo ajustado por maxent.jar (dismo) leído de su archivo .lambdas:
+    # una línea "feature, lambda, min, max" por feature y al final las
+    # constantes de normalización y la entropía
+    def __init__(self, path):
+        self.path = path
+        self.features = []
+        constantes = {}
+
+        with open(path, encoding="utf-8") as f:
+            for linea in f:
+                partes = [p.strip() for p in linea.strip().split(",")]
+                if len(partes) == 4:
+                    nombre, lam, mn, mx = partes
+                    if float(lam) != 0.0:
+                        self.features.append((nombre, float(lam), float(mn), float(mx)))
+                elif len(partes) == 2:
+                    constantes[partes[0]] = float(partes[1])
+
+        self.linear_predictor_normalizer = constantes["linearPredictorNormalizer"]
+        self.density_normalizer = constantes["densityNormalizer"]
+        self.entropy = constantes["entropy"]
+
+        self.variables = sorted({v for nombre, *_ in self.features for v in self._variables_feature(nombre)})
+
+    def _variables_feature(self, nombre):
+        if nombre[0] in "'`":
+            return [nombre[1:]]
+        if nombre.startswith("("):
+            interior = nombre[1:-1]
+            return [interior.split("<", 1)[1]] if "<" in interior else [interior.split("=", 1)[0]]
+        if nombre.endswith("^2"):
+            return [nombre[:-2]]
+        return nombre.split("*")
+
+    def _evaluar_feature(self, nombre, mn, mx, datos, clamp):
+        rango = mx - mn if mx != mn else 1.0
+
+        # Hinge directa ('), inversa (`), umbral (t<v) y categórica (v=c)
+        if nombre[0] == "'":
+            x = datos[nombre[1:]]
+            f = np.where(x <= mn, 0.0, (x - mn) / rango)
+        elif nombre[0] == "`":
+            x = datos[nombre[1:]]
+            f = np.where(x >= mx, 0.0, (mx - x) / rango)
+        elif nombre.startswith("(") and "<" in nombre:
+            umbral, v = nombre[1:-1].split("<", 1)
+            return (datos[v] > float(umbral)).astype(float)
+        elif nombre.startswith("(") and "=" in nombre:
+            v, valor = nombre[1:-1].split("=", 1)
+            return (datos[v] == float(valor)).astype(float)
+
+        # Lineal, cuadrática y producto, escaladas a [0, 1] con el rango de entrenamiento
+        else:
+            if nombre.endswith("^2"):
+                x = datos[nombre[:-2]] ** 2
+            elif "*" in nombre:
+                a, b = nombre.split("*", 1)
+                x = datos[a] * datos[b]
+            else:
+                x = datos[nombre]
+            f = (x - mn) / rango
+
+        # Clamping: fuera del rango de entrenamiento la feature no extrapola
+        return np.clip(f, 0.0, 1.0) if clamp else f
+
+    def predecir(self, datos, salida="cloglog", clamp=True):
+
+        # datos: {variable: arreglo}; todos con la misma forma
+        forma = np.shape(datos[self.variables[0]]) if self.variables else (0,)
+        s = np.zeros(forma)
+        for nombre, lam, mn, mx in self.features:
+            s += lam * self._evaluar_feature(nombre, mn, mx, datos, clamp)
+
+        # log(raw) = s - linearPredictorNormalizer - log(densityNormalizer)
+        log_raw = s - self.linear_predictor_normalizer - np.log(self.density_normalizer)
+
+        if salida == "raw":
+            return np.exp(log_raw)
+        if salida == "logistic":
+            return 1.0 / (1.0 + np.exp(-(log_raw + self.entropy)))
+        if salida == "cloglog":
+            return -np.expm1(-np.exp(log_raw + self.entropy))
+        raise ValueError(f"Formato de salida no soportado: {salida}")
+
+
+def nombre_variable_r(path):
+    # Nombre que raster::stack asigna a cada capa (make.names del archivo)
+    base = os.path.splitext(os.path.basename(path))[0]
+    nombre = re.sub(r"[^0-9A-Za-z._]", ".", base)
+    if not re.match(r"^([A-Za-z]|\.(?![0-9]))", nombre):
+        nombre = "X" + nombre
+    return nombre
+
+
+# =====================================================
+# VALORES DE LOS RÁSTERES EN PUNTOS
+# =====================================================
+def _bloques_puntos(src, x, y):
+
+    # Fila/columna de cada punto con la afín inversa y agrupación por bloque
+    # interno del ráster: (ventana, índices de puntos, filas, columnas)
+    cols, filas = ~src.transform * (x, y)
+    filas = np.floor(filas).astype(np.int64)
+    cols = np.floor(cols).astype(np.int64)
+    dentro = np.flatnonzero((filas >= 0) & (filas < src.height) & (cols >= 0) & (cols < src.width))
+
+    bh, bw = src.block_shapes[0]
+    n_bx = -(-src.width // bw)
+    bloque = (filas[dentro] // bh) * n_bx + cols[dentro] // bw
+
+    orden = dentro[np.argsort(bloque, kind="stable")]
+    ids, inicio = np.unique(np.sort(bloque), return_index=True)
+    grupos = []
+    for b, idx in zip(ids, np.split(orden, inicio[1:])):
+        r0, c0 = int(b // n_bx) * bh, int(b % n_bx) * bw
+        ventana = Window(c0, r0, min(bw, src.width - c0), min(bh, src.height - r0))
+        grupos.append((ventana, idx, filas[idx] - r0, cols[idx] - c0))
+    return grupos
+
+
+def _extraer_capa(path, grupos):
+    valores = []
+    with rasterio_open(path) as src:
+        for ventana, idx, f, c in grupos:
+            arr = src.read(1, window=ventana, masked=True)
+            v = np.ma.getdata(arr)[f, c].astype(np.float32)
+            v[np.ma.getmaskarray(arr)[f, c]] = np.nan
+            valores.append((idx, v))
+    return valores
+
+
+def extraer_valores(raster_paths, x, y, n_workers=None):
+
+    # Matriz float32 (n_puntos, n_capas); NaN fuera del ráster o en nodata.
+    # Los puntos se agrupan por bloque una vez por grilla y cada bloque con
+    # puntos se lee una sola vez por capa; las capas van en hilos (rasterio
+    # libera el GIL al leer)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    out = np.full((len(x), len(raster_paths)), np.nan, dtype=np.float32)
+
+    grupos_por_grilla = {}
+    tareas = []
+    for j, path in enumerate(raster_paths):
+        with rasterio_open(path) as src:
+            clave = (src.crs.to_string() if src.crs else None, tuple(src.transform), src.width, src.height, src.block_shapes[0])
+            if clave not in grupos_por_grilla:
+                grupos_por_grilla[clave] = _bloques_puntos(src, x, y)
+        tareas.append((j, path, grupos_por_grilla[clave]))
+
+    n_workers = max(1, int(n_workers or min(8, os.cpu_count() or 1)))
+    with ThreadPoolExecutor(max_workers=n_workers) as ex:
+        futuros = {ex.submit(_extraer_capa, path, grupos): j for j, path, grupos in tareas}
+        for fut, j in futuros.items():
+            for idx, v in fut.result():
+                out[idx, j] = v
+    return out
+
+
+# =====================================================
+# PREDICCIÓN POR BLOQUES
+# =====================================================
+NODATA_PREDICCION = -9999.0
+
+# Estado de solo lectura de cada proceso worker
+_WORKER = {}
+
+
+def _inicializar_worker(lambdas_paths, capas, salida, clamp):
+    _WORKER["modelos"] = [ModeloLambdas(p) for p in lambdas_paths]
+    _WORKER["capas"] = {v: rasterio_open(p) for v, p in capas.items()}
+    _WORKER["salida"] = salida
+    _WORKER["clamp"] = clamp
+
+
+def predecir_bloque(ventana, modelos, capas, salida="cloglog", clamp=True):
+
+    # Un bloque del stack: cada capa se lee una vez y se evalúan todos los
+    # modelos (réplicas) sobre los píxeles válidos en todas las variables
+    datos = {}
+    valido = np.ones((int(ventana.height), int(ventana.width)), dtype=bool)
+    for v, src in capas.items():
+        # A float antes de rellenar: las capas enteras (DEM, coberturas) no admiten NaN
+        arr = src.read(1, window=ventana, masked=True).astype(np.float64)
+        datos[v] = arr.filled(np.nan)
+        valido &= np.isfinite(datos[v])
+
+    out = np.full((len(modelos),) + valido.shape, NODATA_PREDICCION, dtype=np.float32)
+    if valido.any():
+        sub = {v: x[valido] for v, x in datos.items()}
+        for i, m in enumerate(modelos):
+            out[i][valido] = m.predecir(sub, salida, clamp)
+    return out
+
+
+def _worker_bloque(ventana):
+    w = _WORKER
+    return ventana, predecir_bloque(ventana, w["modelos"], w["capas"], w["salida"], w["clamp"])
+
+
+def predecir_raster(lambdas_paths, raster_paths, out_path, salida="cloglog", clamp=True,
+                    n_workers=None, bloque=512):
+
+    # Una banda por archivo .lambdas (réplica), sobre la grilla del stack
+    lambdas_paths = sorted(lambdas_paths)
+    if not lambdas_paths:
+        raise RuntimeError("No hay modelos .lambdas para predecir")
+
+    modelos = [ModeloLambdas(p) for p in lambdas_paths]
+    por_nombre = {nombre_variable_r(p): p for p in raster_paths}
+    usadas = sorted({v for m in modelos for v in m.variables})
+    faltantes = [v for v in usadas if v not in por_nombre]
+    if faltantes:
+        raise RuntimeError(f"Variables del modelo sin ráster: {', '.join(faltantes)}")
+    capas = {v: por_nombre[v] for v in usadas}
+
+    with rasterio_open(raster_paths[0]) as ref:
+        meta = ref.profile.copy()
+        alto, ancho = ref.height, ref.width
+
+    meta.update(
+        driver="GTiff",
+        count=len(modelos),
+        dtype="float32",
+        nodata=NODATA_PREDICCION,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        BIGTIFF="IF_SAFER",
+    )
+
+    ventanas = [
+        Window(c, f, min(bloque, ancho - c), min(bloque, alto - f))
+        for f in range(0, alto, bloque)
+        for c in range(0, ancho, bloque)
+    ]
+    n_workers = max(1, int(n_workers or min(8, os.cpu_count() or 1)))
+
+    with rasterio_open(out_path, "w", **meta) as dst:
+
+        # Con pocos bloques no compensa arrancar procesos
+        if n_workers == 1 or len(ventanas) < 2 * n_workers:
+            fuentes = {v: rasterio_open(p) for v, p in capas.items()}
+            try:
+                for w in ventanas:
+                    dst.write(predecir_bloque(w, modelos, fuentes, salida, clamp), window=w)
+            finally:
+                for src in fuentes.values():
+                    src.close()
+            return out_path
+
+        # Los bloques se reparten entre procesos; solo este proceso escribe.
+        # Se mantienen pocos bloques en vuelo para acotar la memoria.
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_inicializar_worker,
+            initargs=(lambdas_paths, capas, salida, clamp),
+        ) as ex:
+            pendientes = set()
+            siguiente = iter(ventanas)
+            for w in siguiente:
+                pendientes.add(ex.submit(_worker_bloque, w))
+                if len(pendientes) >= 2 * n_workers:
+                    break
+            while pendientes:
+                hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                for fut in hechos:
+                    w, arr = fut.result()
+                    dst.write(arr, window=w)
+                    nueva = next(siguiente, None)
+                    if nueva is not None:
+                        pendientes.add(ex.submit(_worker_bloque, nueva))
+
+    return out_path
@@ -0,0 +1,138 @@
+import os
+import sys
+import logging
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+from rpy2.robjects import r, globalenv
+from rpy2.robjects.vectors import StrVector
+
+logger = logging.getLogger(__name__)
+
+
+# =====================================================
+# ENTORNO R / JAVA PARA MAXENT
+# =====================================================
+PAQUETES_R = ["raster", "dismo", "readr", "sp", "sf", "codetools", "rJava"]
+
+# Una vez cargados los paquetes y la JVM en este proceso no se repite
+_R_LISTO = False
+
+
+def preparar_entorno_r(lib_path=None, repo_local=None, memoria_mb=None):
+    global _R_LISTO
+    if _R_LISTO:
+        return
+
+    globalenv["paquetes"] = StrVector(PAQUETES_R)
+
+    # El heap de Java (maxent) debe fijarse antes de cargar rJava
+    if memoria_mb:
+        globalenv["javaParams"] = f"-Xmx{max(256, int(memoria_mb * 0.75))}m"
+        r("options(java.parameters = javaParams)")
+
+    # Librería aislada primero; las existentes (R_LIBS_USER, donde las
+    # versiones anteriores instalaban dismo/rJava/sf, .Library.site y
+    # .Library) quedan detrás como respaldo, así un nodo ya desplegado sigue
+    # funcionando aunque la librería aislada esté vacía. Lo que falte se
+    # instala en la aislada (.libPaths()[1])
+    if lib_path:
+        os.makedirs(lib_path, exist_ok=True)
+        globalenv["libPath"] = str(lib_path).replace("\\", "/")
+        r(".libPaths(c(libPath, .libPaths()))")
+
+    faltantes = list(r("paquetes[!vapply(paquetes, requireNamespace, logical(1), quietly = TRUE)]"))
+
+    # Sin red: solo se instala desde un repositorio CRAN local, si existe
+    if faltantes and repo_local:
+        globalenv["faltantes"] = StrVector(faltantes)
+        globalenv["repoLocal"] = "file:///" + str(repo_local).replace("\\", "/").lstrip("/")
+        r("install.packages(faltantes, lib = .libPaths()[1], repos = repoLocal)")
+        faltantes = list(r("paquetes[!vapply(paquetes, requireNamespace, logical(1), quietly = TRUE)]"))
+
+    if faltantes:
+        raise RuntimeError(
+            f"Paquetes R no instalados: {', '.join(faltantes)}. "
+            f"Instálelos en {lib_path or 'la librería de R'} o configure R_REPO_LOCAL"
+        )
+
+    r("""
+    suppressPackageStartupMessages({
+        library(raster)
+        library(dismo)
+        library(readr)
+        library(sp)
+        library(sf)
+        library(codetools)
+        library(rJava)
+    })
+    .jinit()
+    """)
+
+    _R_LISTO = True
+
+
+# =====================================================
+# WORKERS PERSISTENTES
+# =====================================================
+# Procesos aparte, cada uno con su propio R embebido (rpy2 no es seguro entre
+# hilos); se reutilizan entre regiones y peticiones con la sesión R y la JVM
+# cargadas
+_POOL = None
+_POOL_CONFIG = None
+_LOCK = threading.Lock()
+
+
+def limitar_memoria(memoria_mb):
+    # POSIX: límite al segmento de datos (malloc de Python/R y heap de Java
+    # comprometido); RLIMIT_AS no sirve porque la JVM reserva mucho espacio
+    # virtual sin usarlo. En Windows solo aplica el -Xmx de Java.
+    if not memoria_mb or sys.platform == "win32":
+        return
+    import resource
+    limite = int(memoria_mb) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_DATA, (limite, limite))
+
+
+def _inicializar_worker_r(lib_path, repo_local, memoria_mb, preparar_r=True):
+    # El proceso spawn no pasa por django.setup(): log propio a consola
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(processName)s] %(name)s %(levelname)s: %(message)s")
+    limitar_memoria(memoria_mb)
+    if not preparar_r:
+        return
+    # Precalentamiento; si falla, la primera tarea repite y reporta el error
+    try:
+        preparar_entorno_r(lib_path, repo_local, memoria_mb)
+    except Exception as e:
+        logger.warning("Entorno R no preparado: %s", e)
+
+
+def pool_r(lib_path=None, repo_local=None, max_workers=1, memoria_mb=None, preparar_r=True):
+    # preparar_r=False: workers sin precargar R/JVM (motor MaxEnt NumPy)
+    global _POOL, _POOL_CONFIG
+    config = (lib_path, repo_local, max(1, int(max_workers)), memoria_mb, preparar_r)
+    with _LOCK:
+        if _POOL is not None and _POOL_CONFIG != config:
+            _POOL.shutdown(wait=False)
+            _POOL = None
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(
+                max_workers=config[2],
+                mp_context=mp.get_context("spawn"),
+                initializer=_inicializar_worker_r,
+                initargs=(lib_path, repo_local, memoria_mb, preparar_r),
+            )
+            _POOL_CONFIG = config
+        return _POOL
+
+
+def descartar_pool_r(pool):
+    # Tras la caída de un worker ese pool queda inutilizable. Solo se descarta
+    # la instancia indicada: si otra petición ya creó uno nuevo, se conserva
+    global _POOL, _POOL_CONFIG
+    with _LOCK:
+        if _POOL is pool:
+            _POOL = None
+            _POOL_CONFIG = None
+    pool.shutdown(wait=False)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+
+class RedCSR:
+
+    # Grafo de la red segmentada en formato CSR: nodos = extremos de los
+    # segmentos y vértices interiores compartidos con otro segmento (cruces
+    # que no coinciden con un corte de la segmentación), aristas = tramos
+    # entre nodos consecutivos de un segmento con su longitud en metros. Las
+    # posiciones sobre la red se expresan como (segmento, offset en metros
+    # desde su inicio).
+
+    def __init__(self, seg_xy, seg_idx, length_m, m_lat, m_lon, memoria_mb=256):
+
+        n_seg = len(length_m)
+        seg_len = np.asarray(length_m, dtype=float)
+        primero = np.searchsorted(seg_idx, np.arange(n_seg))
+        ultimo = np.r_[primero[1:], len(seg_xy)] - 1
+
+        # Vértices con coordenadas idénticas se funden en un solo punto; son
+        # nodos los extremos y los vértices que aparecen más de una vez
+        _, punto, veces = np.unique(np.round(seg_xy, 9), axis=0, return_inverse=True, return_counts=True)
+        punto = punto.ravel()
+        extremo = np.zeros(len(seg_xy), dtype=bool)
+        extremo[primero] = True
+        extremo[ultimo] = True
+        es_nodo = extremo | (veces[punto] > 1)
+
+        # Offset en metros de cada vértice dentro de su segmento: misma
+        # fracción de longitud que usan el snap y la interpolación
+        d = np.hypot(np.diff(seg_xy[:, 0]), np.diff(seg_xy[:, 1]))
+        paso = np.r_[0.0, np.where(seg_idx[1:] == seg_idx[:-1], d, 0.0)]
+        acum = np.cumsum(paso)
+        acum -= acum[primero][seg_idx]
+        total = acum[ultimo][seg_idx]
+        off_v = np.divide(acum, total, out=np.zeros(len(acum)), where=total > 0) * seg_len[seg_idx]
+
+        # Tramos: pares de nodos consecutivos dentro de cada segmento
+        v_nodo = np.flatnonzero(es_nodo)
+        ids_nodo, nodo_v = np.unique(punto[v_nodo], return_inverse=True)
+        nodo_v = nodo_v.ravel()
+        tramo = np.flatnonzero(seg_idx[v_nodo[1:]] == seg_idx[v_nodo[:-1]])
+        ini, fin = v_nodo[tramo], v_nodo[tramo + 1]
+
+        self.tramo_seg = seg_idx[ini]
+        self.tramo_u = nodo_v[tramo]
+        self.tramo_v = nodo_v[tramo + 1]
+        self.tramo_ini = off_v[ini]
+        self.tramo_fin = off_v[fin]
+        self.tramo_primero = np.searchsorted(self.tramo_seg, np.arange(n_seg))
+        self.tramo_ultimo = np.r_[self.tramo_primero[1:], len(tramo)] - 1
+
+        # Inicio de cada tramo sobre la red concatenada, creciente
+        self.seg_base = np.cumsum(seg_len) - seg_len
+        self.tramo_base = self.seg_base[self.tramo_seg] + self.tramo_ini
+
+        self.seg_len = seg_len
+        self.n_nodos = len(ids_nodo)
+        self.nodos_xy_m = np.zeros((self.n_nodos, 2))
+        self.nodos_xy_m[nodo_v] = seg_xy[v_nodo] * np.array([m_lon, m_lat])
+        self.arbol_nodos = cKDTree(self.nodos_xy_m)
+        self.memoria_bytes = int(memoria_mb) * (1 << 20)
+
+        # Aristas no dirigidas sin lazos; entre dos nodos se conserva la más corta
+        u = np.minimum(self.tramo_u, self.tramo_v)
+        v = np.maximum(self.tramo_u, self.tramo_v)
+        w = self.tramo_fin - self.tramo_ini
+        ok = u != v
+        u, v, w = u[ok], v[ok], w[ok]
+        orden = np.lexsort((w, v, u))
+        u, v, w = u[orden], v[orden], w[orden]
+        unico = np.r_[True, (u[1:] != u[:-1]) | (v[1:] != v[:-1])]
+
+        self.G = csr_matrix((w[unico], (u[unico], v[unico])), shape=(self.n_nodos, self.n_nodos))
+
+    def _ubicar_tramo(self, seg, off):
+
+        # Tramo que contiene cada posición (segmento, offset)
+        k = np.searchsorted(self.tramo_base, self.seg_base[seg] + off, side="right") - 1
+        return np.clip(k, self.tramo_primero[seg], self.tramo_ultimo[seg])
+
+    # ==================================================
+    # DIJKSTRA ACOTADO
+    # ==================================================
+
+    def distancias_desde_nodos(self, fuentes, r_max):
+
+        # Dijkstra multi-fuente con corte en r_max. Un camino de longitud
+        # <= r_max no sale del círculo euclidiano de radio r_max alrededor de
+        # su fuente, así que cada grupo de fuentes cercanas se resuelve sobre el
+        # subgrafo de su caja ampliada (nodos tomados del KD-tree, sin recorrer
+        # toda la red). Devuelve tripletas dispersas
+        # (posición en fuentes, nodo, distancia) con distancia <= r_max.
+        fuentes = np.asarray(fuentes)
+        xy = self.nodos_xy_m
+        tam = max(float(r_max), 1.0)
+
+        celda = np.floor(xy[fuentes] / tam).astype(np.int64)
+        _, grupo = np.unique(celda, axis=0, return_inverse=True)
+        grupo = grupo.ravel()
+        orden = np.argsort(grupo, kind="stable")
+        cortes = np.flatnonzero(np.diff(grupo[orden])) + 1
+
+        filas, cols, dist = [], [], []
+
+        for src in np.split(orden, cortes):
+            lo = xy[fuentes[src]].min(axis=0) - r_max
+            hi = xy[fuentes[src]].max(axis=0) + r_max
+            sub = np.sort(np.asarray(self.arbol_nodos.query_ball_point(
+                (lo + hi) / 2, float((hi - lo).max()) / 2 * (1 + 1e-9), p=np.inf
+            ), dtype=np.int64))
+            G_sub = self.G[sub][:, sub]
+            local = np.searchsorted(sub, fuentes[src])
+
+            lote = max(1, self.memoria_bytes // (8 * max(1, len(sub))))
+            for i in range(0, len(src), lote):
+                d = dijkstra(G_sub, directed=False, indices=local[i:i + lote], limit=r_max)
+                r, c = np.nonzero(np.isfinite(d))
+                filas.append(src[i:i + lote][r])
+                cols.append(sub[c])
+                dist.append(d[r, c])
+
+        if not filas:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        return np.concatenate(filas), np.concatenate(cols), np.concatenate(dist)
+
+    # ==================================================
+    # DISTANCIAS ENTRE POSICIONES
+    # ==================================================
+
+    def distancias_pares(self, seg, off, xy_m, r_max):
+
+        # Distancias de camino mínimo <= r_max entre todos los pares (i < j)
+        # de posiciones sobre la red, ordenadas de menor a mayor. xy_m son las
+        # coordenadas métricas de las posiciones, usadas solo para descartar
+        # pares cuya distancia euclidiana ya supera r_max.
+        seg = np.asarray(seg)
+        off = np.asarray(off, dtype=float)
+
+        pares = cKDTree(xy_m).query_pairs(r_max, output_type="ndarray")
+        if not len(pares):
+            return np.zeros(0)
+        a, b = pares[:, 0], pares[:, 1]
+
+        k = self._ubicar_tramo(seg, off)
+        nodo = np.stack([self.tramo_u[k], self.tramo_v[k]], axis=1)
+        hasta = np.maximum(np.stack([off - self.tramo_ini[k], self.tramo_fin[k] - off], axis=1), 0.0)
+
+        fuentes = np.unique(nodo[np.r_[a, b]])
+        f_pos, f_nodo, f_dist = self.distancias_desde_nodos(fuentes, r_max)
+        clave = f_pos * self.n_nodos + f_nodo
+        orden = np.argsort(clave)
+        clave, f_dist = clave[orden], f_dist[orden]
+
+        d = np.full(len(a), np.inf)
+        for p in (0, 1):
+            k_p = np.searchsorted(fuentes, nodo[a, p]) * self.n_nodos
+            for q in (0, 1):
+                buscada = k_p + nodo[b, q]
+                i = np.minimum(np.searchsorted(clave, buscada), len(clave) - 1)
+                encontrada = clave[i] == buscada
+                d_pq = np.where(encontrada, f_dist[i], np.inf)
+                d = np.minimum(d, hasta[a, p] + d_pq + hasta[b, q])
+
+        mismo = seg[a] == seg[b]
+        d[mismo] = np.minimum(d[mismo], np.abs(off[a][mismo] - off[b][mismo]))
+
+        d = d[d <= r_max]
+        d.sort()
+        return d
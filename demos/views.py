@@ -1,4 +1,4 @@
-import time, os, schedule, json, rasterio, traceback, ee, geemap, requests, json, uuid
+import time, os, logging, schedule, json, rasterio, traceback, ee, geemap, requests, json, uuid
 from django.shortcuts import render, redirect
 from django.http import JsonResponse, FileResponse, HttpResponseNotAllowed, StreamingHttpResponse
 from django.http import HttpResponse
@@ -7,11 +7,12 @@ from google.cloud import storage
 from google.cloud.storage import transfer_manager
 from rasterio.features import shapes
 from django.views.decorators.csrf import csrf_exempt
-from .utils.maxentModel02 import MaxEntWorkflow  # importa tu clase
+from .utils.maxentModel02 import MaxEntWorkflow, ejecutar_regiones_maxent  # importa tu clase
 from .utils.gee.downloadInputsMaxent import download_latest_exports
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 from .forms import SukubunForm
+from .models import SukubunData
 from django.urls import reverse
 # from telegram.ext import *
 # import telegram
@@ -22,6 +23,8 @@ ULR = settings.BOT_URL
 TOKEN = settings.BOT_TOKEN
 CHAT_ID = settings.BOT_CHAT_ID
 
+logger = logging.getLogger(__name__)
+
 def send_telegram_message(msg):
     # Aquí tu implementación real de envío a Telegram
     print("Telegram:", msg)
@@ -379,7 +382,16 @@ def dbSukubun(request):
     if request.method == "POST":
         form = SukubunForm(request.POST, request.FILES)
         if form.is_valid():
-            form.save()
+            sukubun = form.save()
+            # Conversión a Parquet en segundo plano para las corridas de K-Ripley
+            try:
+                precargar_eventos(
+                    sukubun.file.path,
+                    Path(settings.MEDIA_ROOT) / "kripley_cache",
+                    max_jobs=getattr(settings, "KRIPLEY_MAX_JOBS", 1)
+                )
+            except Exception as e:
+                logger.exception("No se pudo precargar el Excel de eventos: %s", e)
             return redirect('db_sukubun')
     else:
         form = SukubunForm()
@@ -665,7 +677,8 @@ def distances_way(request):
 #########################################################################
 # K-riplay
 
-from .utils.kripley02 import KRipley_HS
+from .utils.kripley02 import KRipley_HS, leer_estado, crs_metrico, R_MAX_RED_DEFAULT_M
+from .utils.kripleyJobs import enviar_kripley, listar_salidas, precargar_eventos
 
 @csrf_exempt
 @require_POST
@@ -689,12 +702,18 @@ def runHotRipley(request):
         media_root = Path(settings.MEDIA_ROOT)
         uploads_folder = media_root / "uploads"
 
-        excel_files = list(uploads_folder.glob("*.xlsx")) + list(uploads_folder.glob("*.xls"))
+        # Último SUKUBUN registrado; si no hay registros, el Excel más reciente en uploads
+        sukubun = SukubunData.objects.order_by("-id").first()
+
+        if sukubun is not None and sukubun.file:
+            excel_path = Path(sukubun.file.path)
+        else:
+            excel_files = list(uploads_folder.glob("*.xlsx")) + list(uploads_folder.glob("*.xls"))
 
-        if not excel_files:
-            raise FileNotFoundError(f"No se encontró ningún archivo Excel en {uploads_folder}")
+            if not excel_files:
+                raise FileNotFoundError(f"No se encontró ningún archivo Excel en {uploads_folder}")
 
-        excel_path = max(excel_files, key=lambda f: f.stat().st_mtime)
+            excel_path = max(excel_files, key=lambda f: f.stat().st_mtime)
 
         print("Último Excel encontrado:", excel_path)
 
@@ -731,6 +750,28 @@ def runHotRipley(request):
         n_workers            = int(payload.get("n_workers", 2))
         max_hs_sample_points = payload.get("max_hs_sample_points")
 
+        distance_mode = payload.get("distance_mode", "2d")
+        r_max_m       = payload.get("r_max_m")
+
+        # En modo "red" el radio máximo acota Dijkstra: se valida aquí para
+        # responder 400 en vez de fallar dentro del job
+        if distance_mode not in ("2d", "red"):
+            return JsonResponse({"status": "error", "detail": f"distance_mode no soportado: {distance_mode}"}, status=400)
+        if r_max_m is None and distance_mode == "red":
+            r_max_m = R_MAX_RED_DEFAULT_M
+        if r_max_m is not None:
+            r_max_m = float(r_max_m)
+            if r_max_m < r_start_m:
+                return JsonResponse({"status": "error", "detail": "r_max_m debe ser mayor o igual que r_start_m"}, status=400)
+
+        # true -> EPSG:9377; también acepta un código EPSG métrico explícito
+        metric_crs    = payload.get("metric_crs")
+        if metric_crs:
+            try:
+                metric_crs = crs_metrico(metric_crs)
+            except ValueError as e:
+                return JsonResponse({"status": "error", "detail": str(e)}, status=400)
+
         plot_png = bool(payload.get("plot_png", True))
 
         # ============================
@@ -753,14 +794,14 @@ def runHotRipley(request):
         export_shp_vias_colapsadas_name = "vias_simplificadas.shp"
 
         # ============================
-        # EJECUCIÓN REAL
+        # EJECUCIÓN EN SEGUNDO PLANO
         # ============================
-        KRipley_HS(
-            excel_path,
+        args = (
+            str(excel_path),
             excel_sheet,
             lat_field,
             lon_field,
-            roads_path,
+            str(roads_path),
             str(output_folder),
             simplify_tolerance_m,
             precision_scale,
@@ -779,10 +820,20 @@ def runHotRipley(request):
             n_workers,
             max_hs_sample_points
         )
+        kwargs = {
+            "cache_folder": str(media_root / "kripley_cache"),
+            "distance_mode": distance_mode,
+            "r_max_m": r_max_m,
+            "metric_crs": metric_crs
+        }
+
+        enviar_kripley(output_folder, args, kwargs, getattr(settings, "KRIPLEY_MAX_JOBS", 1))
 
         return JsonResponse({
             "status": "ok",
             "run_id": run_id,
+            "estado": "en_cola",
+            "status_url": reverse("status_kripley", args=[run_id]),
             "output_folder": str(output_folder),
             "outputs": {
                 "ripley": export_csv_ripley_name,
@@ -790,7 +841,7 @@ def runHotRipley(request):
                 "vias": export_shp_vias_colapsadas_name,
                 "metadata": "metadata.json"
             }
-        })
+        }, status=202)
 
     except Exception as e:
         return JsonResponse(
@@ -802,6 +853,30 @@ def runHotRipley(request):
         )
 
 
+def statusHotRipley(request, run_id):
+
+    # run_id viene de uuid4().hex[:8]; cualquier otra cosa no es una corrida
+    if len(run_id) != 8 or any(c not in "0123456789abcdef" for c in run_id):
+        return JsonResponse({"status": "error", "detail": "run_id inválido"}, status=400)
+
+    output_folder = Path(settings.MEDIA_ROOT) / "kripley_runs" / run_id
+    estado = leer_estado(output_folder)
+
+    if estado is None:
+        return JsonResponse({"status": "error", "detail": f"No existe la corrida {run_id}"}, status=404)
+
+    archivos = listar_salidas(output_folder)
+
+    return JsonResponse({
+        "status": "ok",
+        "run_id": run_id,
+        **estado,
+        "archivos": {
+            f: f"{settings.MEDIA_URL}kripley_runs/{run_id}/{f}" for f in archivos
+        }
+    })
+
+
 
 ##########################################################################
 # ====================================================================== #
@@ -902,25 +977,24 @@ def model_maxent(request):
         resultados = {}
 
         # =============================== #
-        # Ejecutar workflow SECUENCIAL    #
+        # Ejecutar workflow EN PARALELO   #
         # =============================== #
-        for region in regiones:
-            try:
-                workflow = MaxEntWorkflow(project_name=region)
-                # Garantizar contexto de rpy2 dentro del mismo thread
-                with localconverter(default_converter):
-                    workflow.run()
-                resultados[region] = "OK"
-            except Exception as e:
+        # Cada región corre en un worker R persistente (sesión R y JVM ya
+        # cargadas), hasta MAXENT_MAX_WORKERS a la vez
+        estado_regiones = ejecutar_regiones_maxent(regiones)
 
+        for region, info in estado_regiones.items():
+            if info["estado"] == "OK":
+                resultados[region] = "OK"
+            else:
                 error_message = (
-                    f"❌ Fallo el proceso de Maxent model. \n\n"
-                    f"Error: {str(e)}"
+                    f"❌ Fallo el proceso de Maxent model ({region}). \n\n"
+                    f"Error: {info['detalle']}"
                 )
 
                 send_telegram_message(error_message)
 
-                resultados[region] = f"ERROR: {str(e)}"
+                resultados[region] = f"ERROR: {info['detalle']}"
 
         # ------------------------------- # 
         #          Notificación           # 
@@ -941,7 +1015,9 @@ def model_maxent(request):
         return JsonResponse({
             "status": "ok",
             "regiones_procesadas": regiones,
-            "resultados": resultados
+            "resultados": resultados,
+            "regiones": estado_regiones,
+            "metricas": {region: info.get("metricas") for region, info in estado_regiones.items()}
         })
 
     except Exception as e:
@@ -179,6 +179,39 @@ MEDIA_ROOT = BASE_DIR / "media"
 # Url del lenguaje R
 # RSCRIPT_PATH = r""
 
+# Librería R aislada para MaxEnt; nunca se instala desde internet. Si faltan
+# paquetes solo se instalan desde un repositorio CRAN local (R_REPO_LOCAL).
+# Migración: mientras esté vacía se usan los paquetes ya instalados en la
+# librería de usuario/sitio de R; para aislar del todo, copiar ahí raster,
+# dismo, readr, sp, sf, codetools y rJava (o instalarlos desde R_REPO_LOCAL)
+R_LIBRARY_PATH = os.environ.get("R_LIBRARY_PATH", str(BASE_DIR / "r_library"))
+R_REPO_LOCAL = os.environ.get("R_REPO_LOCAL")
+
+# Regiones MaxEnt en paralelo (un proceso con su R por región) y memoria por worker
+MAXENT_MAX_WORKERS = int(os.environ.get("MAXENT_MAX_WORKERS", 2))
+MAXENT_WORKER_MEMORY_MB = int(os.environ.get("MAXENT_WORKER_MEMORY_MB", 0)) or None
+
+# Motor de ajuste MaxEnt: "r" (dismo/maxent.jar) o "python" (NumPy, sin JVM)
+MAXENT_ENGINE = os.environ.get("MAXENT_ENGINE", "r")
+
+# Pico de memoria Python por paso en run_metrics.json (tracemalloc, más lento)
+MAXENT_TRACEMALLOC = os.environ.get("MAXENT_TRACEMALLOC", "0") == "1"
+
+# Log de los procesos de la app (pasos MaxEnt, workers) a consola
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "simple": {"format": "%(asctime)s %(name)s %(levelname)s: %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "simple"},
+    },
+    "loggers": {
+        "demos": {"handlers": ["console"], "level": "INFO"},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 